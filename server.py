@@ -1,194 +1,403 @@
+import argparse
 import asyncio
+import itertools
 import json
-import time
-import threading
-<<<<<<< HEAD
-from typing import Dict, Set, Any
-from dataclasses import dataclass, asdict
-=======
-from typing import Set, Any
->>>>>>> 778521bd030d2e2b05e6ab04dd653258e473799b
-from server.playerHandler import PlayerHandler
+import math
+import os
+import signal
+from typing import Dict, Any
+from urllib.parse import parse_qs, urlsplit
+from server.playerHandler import PlayerHandler, MAX_COORDINATE
+from server.chatStore import ChatStore, chat_update_json
+from server.sessionStore import SessionStore
+from server import worldSnapshot
+from server.clientConnection import ClientConnection
+from server.broadcaster import Broadcaster
+from server.sharding import ShardRouter
+from server.metrics import METRICS, serve_admin
+from server.trafficLog import TrafficRecorder
+from server import compression
+from server import wireCodec
+from server import rateLimiter
 
 from websockets.asyncio.server import serve
 
 PORT = 8989
+# Larger frames are refused by the websocket layer before they are parsed
+MAX_MESSAGE_SIZE = 4096
+# Message types clients may send; anything else is dropped right after parsing
+CLIENT_MESSAGE_TYPES = ("player_update", "hello", "chat_send")
+# Longest map / direction name accepted in a player_update
+MAX_NAME_LENGTH = 64
+# Only the game's own maps are accepted; every map name gets a server-wide id for good
+MAPS_DIR = "assets/maps"
+# Without MAPS_DIR, the number of distinct map names accepted
+MAX_MAP_NAMES = 256
+MAP_NAMES: set[str] = set()
+KNOWN_MAPS_ONLY = False
+# Per-message deflate ("deflate" or "off") and its settings, see server/compression.py
+COMPRESSION = "deflate"
+DEFLATE_LEVEL = compression.DEFLATE_LEVEL
+DEFLATE_WINDOW_BITS = compression.DEFLATE_WINDOW_BITS
+DEFLATE_MEM_LEVEL = compression.DEFLATE_MEM_LEVEL
+# Send only changed players between ticks, with a full snapshot every KEYFRAME_INTERVAL ticks
+DELTA_UPDATES = True
+KEYFRAME_INTERVAL = 60
+# Area of interest: only send players within this many pixels of the client (None = whole map)
+AOI_RADIUS: float | None = 1024.0
+BROADCAST_INTERVAL = 0.0167  # 60 updates per second while players move
+# Tick rate while nothing changes
+IDLE_INTERVAL = 0.5
+# Chat is batched into the next tick; this bounds the added delay
+CHAT_MAX_DELAY = 0.05
+# Sharded mode: worker processes (0 = single process) and optional fixed map -> shard
+SHARDS = 0
+SHARD_MAPS: Dict[str, int] = {}
+# State file written every SNAPSHOT_INTERVAL seconds and loaded on startup ("" = disabled)
+SNAPSHOT_PATH = "saves/server_state.snapshot"
+# Inbound traffic log for replay benchmarks ("" = off)
+CAPTURE_PATH = ""
+# Metrics / profiling endpoint on localhost (0 = disabled), see server/metrics.py
+ADMIN_PORT = 8990
+# Multiplies every inbound rate limit (0 = off); raise it for sped-up replays and load tests
+RATE_LIMIT_SCALE = 1.0
 
-PLAYER_HANDLER = PlayerHandler()
-PLAYER_HANDLER.start()
-
-# ------------------------------
-# Simple in-memory chat storage
-# ------------------------------
-class ChatStore:
-    def __init__(self) -> None:
-        self._lock = threading.Lock()
-        self._next_id = 1
-        self._messages: list[dict] = []
-
-    def add(self, sender_id: int, text: str) -> dict:
-        # Sanitize
-        t = (text or "").strip()
-        if len(t) > 200:
-            t = t[:200]
-        if not t:
-            raise ValueError("empty")
-        with self._lock:
-            msg = {
-                "id": self._next_id,
-                "from": sender_id,
-                "text": t,
-                "ts": time.time(),
-            }
-            self._messages.append(msg)
-            self._next_id += 1
-            # Keep only the last N to avoid unbounded growth
-            if len(self._messages) > 1000:
-                self._messages = self._messages[-800:]
-            return msg
-
-    def list_since(self, since_id: int) -> list[dict]:
-        with self._lock:
-            if since_id <= 0:
-                return list(self._messages[-100:])  # cap response size
-            # Find first index with id > since_id
-            # Messages are appended in increasing id order
-            out: list[dict] = []
-            for m in self._messages:
-                if int(m.get("id", 0)) > since_id:
-                    out.append(m)
-            # Cap size
-            if len(out) > 200:
-                out = out[-200:]
-            return out
+PLAYER_HANDLER = PlayerHandler(is_connected=lambda pid: SESSIONS.is_connected(pid))
 
+# In-memory chat history
 CHAT = ChatStore()
 
-# Track connected clients
-CONNECTED_CLIENTS: Set[Any] = set()
-CLIENTS_LOCK = asyncio.Lock()
-
-
-async def broadcast_player_update():
-    """Broadcast player list to all connected clients periodically"""
-    while True:
-        await asyncio.sleep(0.0167)  # 60 updates per second
-        players = PLAYER_HANDLER.list_players()
-        message = {
-            "type": "players_update",
-            "players": players,
-            "timestamp": time.time()
-        }
-        msg_json = json.dumps(message)
-        # Broadcast to all connected clients
-        disconnected = set()
-        async with CLIENTS_LOCK:
-            for client in CONNECTED_CLIENTS:
-                try:
-                    await client.send(msg_json)
-                except Exception:
-                    disconnected.add(client)
-            # Remove disconnected clients
-            CONNECTED_CLIENTS.difference_update(disconnected)
+# Resume tokens, so a reconnecting client keeps its player id
+SESSIONS = SessionStore()
+
+# Connected clients, grouped by map, and the player broadcast tick
+BROADCASTER = Broadcaster(
+    PLAYER_HANDLER,
+    delta_updates=DELTA_UPDATES,
+    keyframe_interval=KEYFRAME_INTERVAL,
+    aoi_radius=AOI_RADIUS,
+    chat_max_delay=CHAT_MAX_DELAY,
+)
+# Set in sharded mode: player state lives in worker processes, see server/sharding.py
+SHARD_ROUTER: ShardRouter | None = None
+# Set with --capture: logs inbound traffic for python -m server.replay
+RECORDER: TrafficRecorder | None = None
+CONNECTION_IDS = itertools.count()
+
+
+def send_error(client: ClientConnection, message: str) -> None:
+    # Error replies are rate limited too, so bad input cannot make us do more work
+    if client.limiter.allow("error"):
+        client.send(json.dumps({
+            "type": "error",
+            "message": message
+        }))
+
+
+def parse_player_update(data: dict) -> tuple | None:
+    """(x, y, map, dir, moving) of a player_update, or None if it can't be used"""
+    x = float(data.get("x", 0))
+    y = float(data.get("y", 0))
+    map_name = data.get("map", "")
+    dir_name = data.get("dir", "down")
+    if not (math.isfinite(x) and math.isfinite(y)) or abs(x) > MAX_COORDINATE or abs(y) > MAX_COORDINATE:
+        return None
+    if not (isinstance(map_name, str) and isinstance(dir_name, str)):
+        return None
+    if len(map_name) > MAX_NAME_LENGTH or len(dir_name) > MAX_NAME_LENGTH:
+        return None
+    if map_name and not map_allowed(map_name):
+        return None
+    return x, y, map_name, dir_name, bool(data.get("moving", False))
+
+
+def load_map_names() -> None:
+    global KNOWN_MAPS_ONLY
+    try:
+        MAP_NAMES.update(name for name in os.listdir(MAPS_DIR) if name.endswith(".tmx"))
+        KNOWN_MAPS_ONLY = True
+    except OSError:
+        print(f"[Server] {MAPS_DIR} not found, accepting up to {MAX_MAP_NAMES} map names")
+
+
+def map_allowed(map_name: str) -> bool:
+    if map_name in MAP_NAMES:
+        return True
+    if KNOWN_MAPS_ONLY or len(MAP_NAMES) >= MAX_MAP_NAMES:
+        return False
+    MAP_NAMES.add(map_name)
+    return True
+
+
+def apply_player_update(client: ClientConnection, x: float, y: float, map_name: str,
+                        dir_name: str, moving: bool) -> None:
+    # Use the server-assigned player_id, not client-provided
+    if SHARD_ROUTER is not None:
+        SHARD_ROUTER.update(client, x, y, map_name, dir_name, moving)
+    else:
+        PLAYER_HANDLER.update(client.player_id, x, y, map_name, dir_name, moving)
+        BROADCASTER.subscribe_map(client, map_name)
+        BROADCASTER.wake()
+
+
+def hold_player_update(client: ClientConnection, update: tuple) -> None:
+    """Over the rate limit: keep only the newest position and apply it once allowed"""
+    waiting = client.held_update is not None
+    client.held_update = update
+    if not waiting:
+        delay = client.limiter.bucket("player_update").wait_time()
+        asyncio.get_running_loop().call_later(delay, flush_held_update, client)
+
+
+def flush_held_update(client: ClientConnection) -> None:
+    update = client.held_update
+    if update is None or client.closed:
+        return
+    if not client.limiter.allow("player_update"):
+        # Tokens were used by newer updates meanwhile; try again later
+        client.held_update = None
+        hold_player_update(client, update)
+        return
+    client.held_update = None
+    apply_player_update(client, *update)
 
 
 async def handle_client(websocket: Any):
     """Handle a WebSocket client connection"""
     player_id = -1
-
-    async with CLIENTS_LOCK:
-        CONNECTED_CLIENTS.add(websocket)
+    conn_id = next(CONNECTION_IDS)
+    client = ClientConnection(websocket)
+    client.start()
+    BROADCASTER.add(client)
+    if RECORDER is not None:
+        RECORDER.connect(conn_id, websocket.request.path)
 
     try:
+        # Reconnecting clients pass ?resume=<token>&chat=<last chat id> in the URL
+        query = parse_qs(urlsplit(websocket.request.path).query)
+        resume_token = query.get("resume", [""])[0]
+        try:
+            last_chat_id = int(query.get("chat", ["0"])[0] or 0)
+        except ValueError:
+            last_chat_id = 0
+        player_id, previous = SESSIONS.resume(client, resume_token) if resume_token else (None, None)
+        if player_id is None:
+            # Not a resumed session (e.g. the server restarted without a snapshot): send all history
+            last_chat_id = 0
+        if previous is not None:
+            # The old socket is dead but not noticed yet: replace it
+            previous.close()
+
         # Register player on connection - server assigns ID
-        player_id = PLAYER_HANDLER.register()
-        await websocket.send(json.dumps({
+        if SHARD_ROUTER is not None:
+            player_id = SHARD_ROUTER.register(client, player_id)
+        else:
+            if player_id is not None:
+                PLAYER_HANDLER.unregister(player_id)
+            player_id = PLAYER_HANDLER.register(player_id)
+        client.player_id = player_id
+        token = SESSIONS.token_of(client) or SESSIONS.create(client, player_id)
+        client.send(json.dumps({
             "type": "registered",
-            "id": player_id
-        }))
-        # Send initial player list
-        players = PLAYER_HANDLER.list_players()
-        await websocket.send(json.dumps({
-            "type": "players_update",
-            "players": players,
-            "timestamp": time.time()
-        }))
-        # Send recent chat messages
-        recent_chat = CHAT.list_since(0)
-        await websocket.send(json.dumps({
-            "type": "chat_update",
-            "messages": recent_chat
+            "id": player_id,
+            "token": token
         }))
+        restored = SESSIONS.take_restored(client)
+        if restored and restored.get("map") and map_allowed(str(restored["map"])):
+            # Resumed after a server restart: put the player back where it was
+            apply_player_update(client, float(restored["x"]), float(restored["y"]), str(restored["map"]),
+                                str(restored.get("dir", "down")), bool(restored.get("moving", False)))
+        # The player list of a map is sent once the client reports which map it is on
+        # Send recent chat messages (only the missed ones after a reconnect)
+        fragments = CHAT.fragments_since(last_chat_id)
+        if fragments or not last_chat_id:
+            client.send(chat_update_json(fragments))
         # Handle incoming messages
         async for message in websocket:
+            if RECORDER is not None:
+                RECORDER.message(conn_id, message)
+            # A flood is dropped before any parsing
+            if not client.limiter.allow("*"):
+                METRICS.count("rate_limited.*")
+                continue
             try:
-                data = json.loads(message)
+                if isinstance(message, bytes):
+                    data = wireCodec.decode(message, client.maps_in)
+                    if data is None:
+                        continue
+                else:
+                    data = json.loads(message)
                 msg_type = data.get("type")
+                if msg_type not in CLIENT_MESSAGE_TYPES:
+                    # Counter names must not come from client input: they are never removed
+                    METRICS.count("in.other")
+                    continue
+                METRICS.count(f"in.{msg_type}")
                 if msg_type == "player_update":
                     # Update player position - use server-assigned ID, ignore client ID
-                    x = float(data.get("x", 0))
-                    y = float(data.get("y", 0))
-                    map_name = str(data.get("map", ""))
-                    dir_name = str(data.get("dir", "down"))
-                    moving = bool(data.get("moving", False))
+                    update = parse_player_update(data)
+                    if update is None:
+                        send_error(client, "invalid_update")
+                    elif client.limiter.allow("player_update"):
+                        client.held_update = None
+                        apply_player_update(client, *update)
+                    else:
+                        METRICS.count("rate_limited.player_update")
+                        hold_player_update(client, update)
 
-                    # Use the server-assigned player_id, not client-provided
-                    PLAYER_HANDLER.update(player_id, x, y, map_name, dir_name, moving)
+                elif not client.limiter.allow(msg_type):
+                    METRICS.count(f"rate_limited.{msg_type}")
+                    if msg_type == "chat_send":
+                        send_error(client, "rate_limited")
+
+                elif msg_type == "hello":
+                    # Codec negotiation; clients that never say hello stay on JSON
+                    codecs = data.get("codecs", [])
+                    if wireCodec.CODEC_BINARY in codecs:
+                        client.codec = wireCodec.CODEC_BINARY
+                        BROADCASTER.request_keyframe(client)
+                        if SHARD_ROUTER is not None:
+                            SHARD_ROUTER.set_codec(client)
+                    # One frame per tick; shard workers send their frames separately
+                    client.batching = bool(data.get("batch")) and SHARD_ROUTER is None
+                    client.send(json.dumps({
+                        "type": "codec",
+                        "codec": client.codec,
+                        "batch": client.batching
+                    }))
 
                 elif msg_type == "chat_send":
                     # Send chat message - use server-assigned ID
                     text = str(data.get("text", ""))
                     if text:
                         try:
-                            msg = CHAT.add(player_id, text)  # Use server-assigned ID
-                            # Broadcast to all clients
-                            chat_msg = {
-                                "type": "chat_update",
-                                "messages": [msg]
-                            }
-                            chat_json = json.dumps(chat_msg)
-                            async with CLIENTS_LOCK:
-                                disconnected = set()
-                                for client in CONNECTED_CLIENTS:
-                                    try:
-                                        await client.send(chat_json)
-                                    except Exception:
-                                        disconnected.add(client)
-                                CONNECTED_CLIENTS.difference_update(disconnected)
+                            _, fragment = CHAT.add(player_id, text)  # Use server-assigned ID
+                            # Broadcast to all clients with the next tick
+                            BROADCASTER.queue_chat(fragment)
                         except ValueError:
-                            await websocket.send(json.dumps({
-                                "type": "error",
-                                "message": "empty_message"
-                            }))
+                            send_error(client, "empty_message")
             except json.JSONDecodeError:
-                await websocket.send(json.dumps({
-                    "type": "error",
-                    "message": "invalid_json"
-                }))
+                send_error(client, "invalid_json")
             except Exception as e:
-                await websocket.send(json.dumps({
-                    "type": "error",
-                    "message": str(e)
-                }))
+                send_error(client, str(e))
 
     except Exception:
         pass
     finally:
-        # Unregister player on disconnect
-        if player_id >= 0:
-            PLAYER_HANDLER.unregister(player_id)
-        async with CLIENTS_LOCK:
-            CONNECTED_CLIENTS.discard(websocket)
+        if RECORDER is not None:
+            RECORDER.disconnect(conn_id)
+        # Unregister player on disconnect, unless a resumed connection took it over
+        player = PLAYER_HANDLER.players.get(client.player_id) if SHARD_ROUTER is None else None
+        if SESSIONS.release(client, player.record() if player is not None else None):
+            if SHARD_ROUTER is not None:
+                SHARD_ROUTER.unregister(client)
+            else:
+                PLAYER_HANDLER.unregister(player_id)
+        BROADCASTER.drop({client})
+        BROADCASTER.wake()
+
+
+def queue_depths() -> dict:
+    """Outbound queue depth over all connected clients"""
+    depths = [c.pending for c in BROADCASTER.clients]
+    return {
+        "max": max(depths, default=0),
+        "mean": sum(depths) / len(depths) if depths else 0.0,
+        "lagging": sum(1 for c in BROADCASTER.clients if c.lagging),
+    }
 
 
 async def main():
+    global SHARD_ROUTER, RECORDER
     print(f"[Server] Running WebSocket server on ws://0.0.0.0:{PORT}")
-    # Start broadcast task
-    asyncio.create_task(broadcast_player_update())
+    load_map_names()
+    METRICS.gauge("clients", lambda: len(BROADCASTER.clients))
+    METRICS.gauge("players", lambda: len(PLAYER_HANDLER.players))
+    METRICS.gauge("queue_depth", queue_depths)
+    METRICS.gauge("tick_interval", lambda: BROADCASTER.current_interval)
+    if CAPTURE_PATH:
+        RECORDER = TrafficRecorder(CAPTURE_PATH)
+        print(f"[Server] Capturing inbound traffic to {CAPTURE_PATH}")
+    if ADMIN_PORT:
+        await serve_admin("127.0.0.1", ADMIN_PORT)
+        print(f"[Server] Metrics on http://127.0.0.1:{ADMIN_PORT}/metrics")
+    if SHARDS > 0:
+        # Player registry and broadcast tick run in worker processes
+        SHARD_ROUTER = ShardRouter(SHARDS, SHARD_MAPS, {
+            "interval": BROADCAST_INTERVAL,
+            "idle_interval": IDLE_INTERVAL,
+            "delta_updates": DELTA_UPDATES,
+            "keyframe_interval": KEYFRAME_INTERVAL,
+            "aoi_radius": AOI_RADIUS,
+        })
+        await SHARD_ROUTER.start()
+        print(f"[Server] Sharded across {SHARDS} worker processes")
+    else:
+        # Start timeout sweeper and broadcast task
+        PLAYER_HANDLER.start()
+        asyncio.create_task(BROADCASTER.run(BROADCAST_INTERVAL, IDLE_INTERVAL))
+    if SNAPSHOT_PATH:
+        # Warm start from the last snapshot, then keep writing new ones in the background
+        registry = SHARD_ROUTER if SHARD_ROUTER is not None else PLAYER_HANDLER
+        state = worldSnapshot.read(SNAPSHOT_PATH)
+        if state is not None:
+            try:
+                worldSnapshot.restore(state, registry, CHAT, SESSIONS)
+                print(f"[Server] Restored {len(state['sessions'])} sessions and {len(state['chat'])} chat messages")
+            except (KeyError, TypeError, ValueError) as e:
+                # Readable but not a state we wrote; start with whatever was restored so far
+                worldSnapshot.set_aside(SNAPSHOT_PATH, e)
+        asyncio.create_task(worldSnapshot.run(SNAPSHOT_PATH, worldSnapshot.SNAPSHOT_INTERVAL, registry,
+                                              PLAYER_HANDLER.list_players, CHAT, SESSIONS))
     # Start server
-    async with serve(handle_client, "0.0.0.0", PORT):
-        await asyncio.Future()  # run forever
+    try:
+        stop = asyncio.Event()
+        try:
+            # Shut down cleanly on SIGTERM too, so the last snapshot gets written
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        except (NotImplementedError, AttributeError):
+            pass  # Windows
+        if COMPRESSION == "deflate":
+            extensions = [compression.deflate_extension(DEFLATE_LEVEL, DEFLATE_WINDOW_BITS, DEFLATE_MEM_LEVEL)]
+        else:
+            extensions = []
+        async with serve(handle_client, "0.0.0.0", PORT, max_size=MAX_MESSAGE_SIZE,
+                         compression=None, extensions=extensions):
+            await stop.wait()  # run until stopped
+    finally:
+        if SHARD_ROUTER is not None:
+            SHARD_ROUTER.stop()
+        if RECORDER is not None:
+            RECORDER.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monster Go websocket server")
+    parser.add_argument("--shards", type=int, default=SHARDS,
+                        help="run player state in this many worker processes (0 = single process)")
+    parser.add_argument("--admin-port", type=int, default=ADMIN_PORT,
+                        help="localhost port for /metrics and /profile (0 = disabled)")
+    parser.add_argument("--snapshot", default=SNAPSHOT_PATH,
+                        help="state file for warm restarts (empty = disabled)")
+    parser.add_argument("--capture", default=CAPTURE_PATH,
+                        help="record inbound traffic to this file, replacing it (replay with python -m server.replay)")
+    parser.add_argument("--compression", choices=["deflate", "off"], default=COMPRESSION,
+                        help="per-message deflate for websocket frames")
+    parser.add_argument("--deflate-level", type=int, default=DEFLATE_LEVEL)
+    parser.add_argument("--deflate-window-bits", type=int, default=DEFLATE_WINDOW_BITS)
+    parser.add_argument("--deflate-mem-level", type=int, default=DEFLATE_MEM_LEVEL)
+    parser.add_argument("--rate-limit-scale", type=float, default=RATE_LIMIT_SCALE,
+                        help="multiply inbound rate limits by this (0 = off, for benchmarks only)")
+    args = parser.parse_args()
+    SHARDS = args.shards
+    COMPRESSION = args.compression
+    DEFLATE_LEVEL = args.deflate_level
+    DEFLATE_WINDOW_BITS = args.deflate_window_bits
+    DEFLATE_MEM_LEVEL = args.deflate_mem_level
+    CAPTURE_PATH = args.capture
+    ADMIN_PORT = args.admin_port
+    SNAPSHOT_PATH = args.snapshot
+    RATE_LIMIT_SCALE = args.rate_limit_scale
+    if RATE_LIMIT_SCALE != 1.0:
+        rateLimiter.scale_limits(RATE_LIMIT_SCALE)
     asyncio.run(main())
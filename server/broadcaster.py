@@ -0,0 +1,307 @@
+import asyncio
+import json
+import time
+import traceback
+from typing import Callable, Dict, Set
+
+from server.playerHandler import PlayerHandler
+from server.clientConnection import ClientConnection
+from server.chatStore import chat_update_json
+from server.metrics import METRICS
+from server import wireCodec
+
+# Adaptive tick rate: heartbeat while nothing changes, and how far to slow down under load
+IDLE_INTERVAL = 0.5
+MAX_INTERVAL_FACTOR = 4
+# A tick using more than this share of its interval counts as overloaded
+BUSY_FRACTION = 0.5
+
+
+def encode_players(codec: str, msg_type: str, players: dict, removed: list[int],
+                   timestamp: float, maps: wireCodec.MapTable) -> str | bytes:
+    """Encode a players_update / players_delta message for the given codec"""
+    started = time.perf_counter()
+    if codec == wireCodec.CODEC_BINARY:
+        data = wireCodec.encode_players(msg_type, players, removed, timestamp, maps)
+    else:
+        message = {
+            "type": msg_type,
+            "players": players,
+            "timestamp": timestamp
+        }
+        if msg_type == "players_delta":
+            message["removed"] = removed
+        data = json.dumps(message)
+    METRICS.observe(f"encode.{codec}", (time.perf_counter() - started) * 1000)
+    return data
+
+
+class Broadcaster:
+    """
+    Connected clients grouped by map, and the periodic player broadcast to them.
+
+    Each tick sends only what changed (with a full keyframe every `keyframe_interval`
+    ticks), only to the clients on the same map, and when `aoi_radius` is set only
+    the players near each client. Sends just enqueue on the client's own writer.
+    Chat messages are held back until the next tick (at most `chat_max_delay` seconds)
+    and go out together as one chat_update. `run` ticks at full rate only while
+    something changes and slows down instead of falling behind when ticks get expensive.
+    """
+    handler: PlayerHandler
+    clients: Set[ClientConnection]
+    # Interest management: clients grouped by the map they last reported
+    map_subscribers: Dict[str, Set[ClientConnection]]
+    # Map ids used by the binary codec
+    map_table: wireCodec.MapTable
+
+    def __init__(self, handler: PlayerHandler, *, delta_updates: bool = True,
+                 keyframe_interval: int = 60, aoi_radius: float | None = None,
+                 chat_max_delay: float = 0.05):
+        self.handler = handler
+        self.delta_updates = delta_updates
+        self.keyframe_interval = keyframe_interval
+        self.aoi_radius = aoi_radius
+        self.chat_max_delay = chat_max_delay
+
+        self.clients = set()
+        self.map_subscribers = {}
+        self.map_table = wireCodec.MapTable()
+        self._last_version = 0
+        self._tick = 0
+        # Chat fragments waiting for the next flush
+        self._chat_pending: list[str] = []
+        self._chat_timer: asyncio.TimerHandle | None = None
+        # Set when something changes while the tick loop is idle
+        self._wake = asyncio.Event()
+        # Tick interval currently used by run()
+        self.current_interval = 0.0
+
+    # Clients
+    def add(self, client: ClientConnection) -> None:
+        self.clients.add(client)
+
+    def _unsubscribe(self, client: ClientConnection) -> None:
+        if client.map:
+            subscribers = self.map_subscribers.get(client.map)
+            if subscribers is not None:
+                subscribers.discard(client)
+                if not subscribers:
+                    del self.map_subscribers[client.map]
+        client.map = ""
+        client.needs_keyframe = False
+        client.known = set()
+
+    def subscribe_map(self, client: ClientConnection, map_name: str) -> None:
+        """Move a client to the subscriber group of `map_name`"""
+        if client.map == map_name or client not in self.clients:
+            return
+        self._unsubscribe(client)
+        if map_name:
+            client.map = map_name
+            self.map_subscribers.setdefault(map_name, set()).add(client)
+            # Clients that just entered a map need a full snapshot of it
+            client.needs_keyframe = True
+            self._wake.set()
+
+    def drop(self, clients: Set[ClientConnection]) -> None:
+        for client in clients:
+            self._unsubscribe(client)
+            client.stop()
+        self.clients.difference_update(clients)
+
+    def broadcast(self, data: str | bytes) -> None:
+        """Queue one encoded frame for every connected client"""
+        disconnected = set()
+        for client in list(self.clients):
+            if client.closed:
+                disconnected.add(client)
+            else:
+                client.send(data)
+        self.drop(disconnected)
+
+    # Chat
+    def queue_chat(self, fragment: str) -> None:
+        """Deliver a pre-serialized chat message with the next flush"""
+        self._chat_pending.append(fragment)
+        if self._chat_timer is None:
+            # Bound the added latency even if no tick comes first
+            self._chat_timer = asyncio.get_running_loop().call_later(self.chat_max_delay, self.flush_chat)
+
+    def flush_chat(self) -> None:
+        """Send every pending chat message as one chat_update"""
+        if self._chat_timer is not None:
+            self._chat_timer.cancel()
+            self._chat_timer = None
+        if not self._chat_pending:
+            return
+        data = chat_update_json(self._chat_pending)
+        self._chat_pending = []
+        METRICS.count("out.chat_update", len(self.clients))
+        self.broadcast(data)
+
+    # Player updates
+    def _define_map(self, client: ClientConnection, map_name: str) -> None:
+        # Binary clients learn each map id once, before the first frame using it
+        map_id = self.map_table.id_for(map_name)
+        if map_id not in client.maps_sent:
+            client.maps_sent.add(map_id)
+            client.send(wireCodec.encode_map_define(map_id, map_name))
+
+    def _aoi_message(self, client: ClientConnection, changed: dict, keyframe: bool, now: float) -> str | bytes | None:
+        """Players near this client: new / changed ones, and ids that went out of range"""
+        visible = self.handler.nearby(client.player_id, self.aoi_radius)
+        known = client.known
+        client.known = visible
+        if keyframe:
+            return encode_players(client.codec, "players_update", self.handler.get_players(visible),
+                                  [], now, self.map_table)
+        entered = visible - known
+        players = self.handler.get_players(entered) if entered else {}
+        for other in visible:
+            if other in changed:
+                players[other] = changed[other]
+        removed = list(known - visible)
+        if not players and not removed:
+            return None
+        return encode_players(client.codec, "players_delta", players, removed, now, self.map_table)
+
+    def tick(self) -> None:
+        """Send one round of player updates (and the chat batched since the last one)"""
+        started = time.perf_counter()
+        # Clients that asked for it get everything of this tick as one frame
+        batching = [c for c in self.clients if c.batching]
+        for client in batching:
+            client.hold()
+        try:
+            self._tick_players()
+        finally:
+            now = time.time()
+            for client in batching:
+                client.release(now)
+        METRICS.observe("tick", (time.perf_counter() - started) * 1000)
+
+    def _tick_players(self) -> None:
+        self.flush_chat()
+        handler = self.handler
+        aoi_radius = self.aoi_radius
+        self._tick += 1
+        now = time.time()
+        full_tick = not self.delta_updates or self._tick % self.keyframe_interval == 0
+        # Snapshot the subscriber groups; nothing below awaits, sends only enqueue
+        groups_snapshot = {m: list(subs) for m, subs in self.map_subscribers.items()}
+        pending = any(c.needs_keyframe for subs in groups_snapshot.values() for c in subs)
+        # Raw message per map: (type, players, removed)
+        keyframes: Dict[str, tuple[str, dict, list[int]]] = {}
+        deltas: Dict[str, tuple[dict, list[int]]] = {}
+        version = handler.version
+        if aoi_radius is None and (full_tick or pending):
+            groups, version = handler.snapshot_by_map()
+            for map_name in groups_snapshot:
+                keyframes[map_name] = ("players_update", groups.get(map_name, {}), [])
+        if not full_tick:
+            deltas, version = handler.changes_by_map(self._last_version)
+        handler.forget_removed(version)
+        self._last_version = version
+        if aoi_radius is None and not keyframes and not deltas:
+            return
+        # Each payload is serialized once per (map, kind, codec) and shared by its subscribers
+        encoded: Dict[tuple[str, bool, str], str | bytes | None] = {}
+        # Queue for the clients of each map
+        disconnected = set()
+        for map_name, subscribers in groups_snapshot.items():
+            changed, removed = deltas.get(map_name, ({}, []))
+            for client in subscribers:
+                if client.closed:
+                    disconnected.add(client)
+                    continue
+                if client.lagging:
+                    # Downgraded to keyframes only until its queue drains
+                    if not full_tick or client.pending:
+                        continue
+                    client.lagging = False
+                keyframe = full_tick or client.needs_keyframe
+                if client.codec == wireCodec.CODEC_BINARY:
+                    self._define_map(client, map_name)
+                if aoi_radius is not None:
+                    # Per-client payload limited to nearby players
+                    data = self._aoi_message(client, changed, keyframe, now)
+                else:
+                    key = (map_name, keyframe, client.codec)
+                    if key in encoded:
+                        data = encoded[key]
+                    else:
+                        data = None
+                        if keyframe:
+                            data = encode_players(client.codec, *keyframes[map_name], now, self.map_table)
+                        elif changed or removed:
+                            data = encode_players(client.codec, "players_delta", changed, removed,
+                                                  now, self.map_table)
+                        encoded[key] = data
+                if data is None:
+                    continue
+                METRICS.count("out.players_update" if keyframe else "out.players_delta")
+                if client.send(data) and keyframe:
+                    client.needs_keyframe = False
+        # Remove disconnected clients
+        self.drop(disconnected)
+
+    def idle(self) -> bool:
+        """True if no player changed and no chat is waiting since the last tick"""
+        return self.handler.version == self._last_version and not self._chat_pending
+
+    def wake(self) -> None:
+        """Tell an idle tick loop that there is something to send"""
+        if not self._wake.is_set() and not self.idle():
+            self._wake.set()
+
+    def request_keyframe(self, client: ClientConnection) -> None:
+        """Send the client a full snapshot of its map on the next tick"""
+        if client.map:
+            client.needs_keyframe = True
+            self._wake.set()
+
+    async def run(self, interval: float, idle_interval: float = IDLE_INTERVAL,
+                  on_tick: Callable[[], None] | None = None) -> None:
+        """
+        Tick every `interval` seconds while players change, on fixed deadlines so the
+        time spent ticking does not add up. When idle, wait for wake() or a heartbeat
+        every `idle_interval`; when ticks get too slow, stretch the interval.
+        """
+        loop = asyncio.get_running_loop()
+        max_interval = interval * MAX_INTERVAL_FACTOR
+        self.current_interval = interval
+        deadline = loop.time() + interval
+        while True:
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            woke = False
+            if self.idle() and not self._wake.is_set():
+                woke = True
+                try:
+                    await asyncio.wait_for(self._wake.wait(), idle_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wake.clear()
+            started = loop.time()
+            try:
+                self.tick()
+                if on_tick is not None:
+                    on_tick()
+            except Exception:
+                # One bad tick must not end broadcasting for everyone
+                METRICS.count("tick.errors")
+                traceback.print_exc()
+            now = loop.time()
+            took = now - started
+            # Back off while ticks eat most of their interval, recover once they are cheap
+            if took > self.current_interval * BUSY_FRACTION:
+                self.current_interval = min(self.current_interval * 1.25, max_interval)
+            elif self.current_interval > interval and took < self.current_interval * BUSY_FRACTION / 2:
+                self.current_interval = max(self.current_interval * 0.9, interval)
+            deadline += self.current_interval
+            if deadline < now:
+                # Fell behind (or woke from idle): skip missed ticks instead of bursting
+                if not woke:
+                    METRICS.count("tick.behind")
+                deadline = now + self.current_interval
@@ -0,0 +1,107 @@
+import bisect
+import json
+import time
+from typing import Optional
+
+# Messages kept for history / reconnects
+CHAT_CAPACITY = 1000
+# Most messages returned to a new client, and to a client catching up
+RECENT_LIMIT = 100
+SINCE_LIMIT = 200
+MAX_TEXT_LENGTH = 200
+
+
+class ChatStore:
+    """
+    In-memory chat history owned by the server's event loop.
+
+    Messages live in a fixed-size ring of parallel arrays (id, message, JSON fragment).
+    Ids only grow, so `list_since` finds its start with a bisect instead of a scan, and
+    each message is serialized once when added; chat_update payloads are assembled from
+    those fragments without dumping the dicts again.
+    """
+    _ids: list[int]
+    _messages: list[Optional[dict]]
+    _fragments: list[Optional[str]]
+    # Physical index of the oldest message, and how many are stored
+    _head: int
+    _count: int
+
+    def __init__(self, capacity: int = CHAT_CAPACITY) -> None:
+        self._capacity = capacity
+        self._next_id = 1
+        self._ids = [0] * capacity
+        self._messages = [None] * capacity
+        self._fragments = [None] * capacity
+        self._head = 0
+        self._count = 0
+
+    def add(self, sender_id: int, text: str) -> tuple[dict, str]:
+        """Store a message, return it and its JSON fragment"""
+        # Sanitize
+        t = (text or "").strip()
+        if len(t) > MAX_TEXT_LENGTH:
+            t = t[:MAX_TEXT_LENGTH]
+        if not t:
+            raise ValueError("empty")
+        msg = {
+            "id": self._next_id,
+            "from": sender_id,
+            "text": t,
+            "ts": time.time(),
+        }
+        fragment = json.dumps(msg)
+        self._next_id += 1
+        self._store(msg, fragment)
+        return msg, fragment
+
+    def _store(self, msg: dict, fragment: str) -> None:
+        # Overwrite the oldest slot once full
+        if self._count < self._capacity:
+            slot = (self._head + self._count) % self._capacity
+            self._count += 1
+        else:
+            slot = self._head
+            self._head = (self._head + 1) % self._capacity
+        self._ids[slot] = msg["id"]
+        self._messages[slot] = msg
+        self._fragments[slot] = fragment
+
+    def export(self) -> tuple[list[dict], int]:
+        """Every stored message, oldest first, and the next id (for snapshots)"""
+        return [self._messages[(self._head + i) % self._capacity] for i in range(self._count)], self._next_id
+
+    def load(self, messages: list[dict], next_id: int) -> None:
+        """Refill from export() output"""
+        self._head = 0
+        self._count = 0
+        for msg in messages:
+            self._store(msg, json.dumps(msg))
+        self._next_id = max(next_id, messages[-1]["id"] + 1 if messages else 1)
+
+    def _slots_since(self, since_id: int) -> range:
+        # Logical indices (0 = oldest) of the messages to return
+        if since_id <= 0:
+            limit = RECENT_LIMIT  # cap response size
+            start = 0
+        else:
+            limit = SINCE_LIMIT
+            head, capacity, ids = self._head, self._capacity, self._ids
+            start = bisect.bisect_right(range(self._count), since_id,
+                                        key=lambda i: ids[(head + i) % capacity])
+        return range(max(start, self._count - limit), self._count)
+
+    def list_since(self, since_id: int) -> list[dict]:
+        return [self._messages[(self._head + i) % self._capacity] for i in self._slots_since(since_id)]
+
+    def fragments_since(self, since_id: int) -> list[str]:
+        return [self._fragments[(self._head + i) % self._capacity] for i in self._slots_since(since_id)]
+
+    @property
+    def last_id(self) -> int:
+        return self._next_id - 1
+
+
+def chat_update_json(fragments: list[str]) -> str:
+    """chat_update payload built from pre-serialized messages"""
+    return '{"type": "chat_update", "messages": [' + ", ".join(fragments) + "]}"
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional, Set
+
+from server import compression
+from server.metrics import METRICS
+from server.rateLimiter import RateLimiter
+from server.wireCodec import CODEC_JSON, MapTable, encode_batch
+
+# Frames a client may have waiting before it is considered lagging
+OUTBOUND_QUEUE_SIZE = 64
+# Maps a binary client may define for its own updates
+CLIENT_MAP_LIMIT = 64
+
+
+@dataclass(eq=False)
+class ClientConnection:
+    """
+    One connected client: its subscription state and a bounded outbound queue
+    drained by its own writer task, so a slow socket never blocks the sender.
+    """
+    websocket: Any
+    player_id: int = -1
+    # Map the client last reported (interest management)
+    map: str = ""
+    # Player ids this client has been sent (area of interest)
+    known: Set[int] = field(default_factory=set)
+    # Send a full snapshot on the next tick
+    needs_keyframe: bool = False
+    # Queue overflowed: only keyframes until it drains
+    lagging: bool = False
+    closed: bool = False
+    # Negotiated wire format and the binary codec's map tables
+    codec: str = CODEC_JSON
+    maps_sent: Set[int] = field(default_factory=set)
+    maps_in: MapTable = field(default_factory=lambda: MapTable(CLIENT_MAP_LIMIT))
+    # Inbound rate limits, and the newest position held back by them
+    limiter: RateLimiter = field(default_factory=RateLimiter)
+    held_update: Optional[tuple] = None
+    # Client asked for one frame per tick; frames are collected between hold() and release()
+    batching: bool = False
+    _batch: Optional[list] = None
+
+    _queue: Optional[asyncio.Queue] = None
+    _writer: Optional[asyncio.Task] = None
+    _closer: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def stop(self) -> None:
+        self.closed = True
+        if self._writer:
+            self._writer.cancel()
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def hold(self) -> None:
+        """Collect sends until release() instead of queueing them one by one"""
+        if self.batching:
+            self._batch = []
+
+    def release(self, timestamp: float) -> None:
+        """Queue what was collected since hold() as a single frame"""
+        batch, self._batch = self._batch, None
+        if batch:
+            self._enqueue(batch[0] if len(batch) == 1 else encode_batch(batch, timestamp))
+
+    def send(self, data: str | bytes) -> bool:
+        """Queue an already encoded frame, return False if it was not queued"""
+        if self._batch is not None and not self.closed:
+            self._batch.append(data)
+            return True
+        return self._enqueue(data)
+
+    def _enqueue(self, data: str | bytes) -> bool:
+        if self.closed or self._queue is None:
+            return False
+        try:
+            self._queue.put_nowait(data)
+            return True
+        except asyncio.QueueFull:
+            if self.lagging:
+                # Still overflowing on keyframes only: give up on this client
+                METRICS.count("clients.dropped")
+                self.close()
+            else:
+                METRICS.count("clients.lagging")
+                self.lagging = True
+            return False
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.stop()
+        self._closer = asyncio.create_task(self.websocket.close())
+
+    async def _write_loop(self) -> None:
+        try:
+            while True:
+                data = await self._queue.get()
+                started = time.perf_counter()
+                await self.websocket.send(data)
+                METRICS.observe("send", (time.perf_counter() - started) * 1000)
+                METRICS.count("out.frames")
+                METRICS.count("out.bytes", len(data))
+                compression.sample(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.closed = True
@@ -0,0 +1,64 @@
+"""
+Per-message deflate settings for the websocket server, and a sampled estimate of what
+compression saves, published in the metrics.
+
+websockets compresses inside send() and does not report wire sizes, so every
+SAMPLE_EVERY-th outgoing frame is also compressed here with the same settings. That
+sample gives `compression.ratio`; the time send() takes (histogram "send") includes
+the real compression work.
+"""
+import zlib
+from typing import Optional
+
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+from server.metrics import METRICS
+
+# zlib level, LZ77 window (9-15 bits) and memory level (1-9); smaller is cheaper per client
+DEFLATE_LEVEL = 6
+DEFLATE_WINDOW_BITS = 12
+DEFLATE_MEM_LEVEL = 5
+SAMPLE_EVERY = 64
+
+_settings: Optional[tuple[int, int, int]] = None
+_frames = 0
+
+
+def deflate_extension(level: int = DEFLATE_LEVEL, window_bits: int = DEFLATE_WINDOW_BITS,
+                      mem_level: int = DEFLATE_MEM_LEVEL) -> ServerPerMessageDeflateFactory:
+    """Extension for serve(extensions=...); also turns on the sampled estimate"""
+    global _settings
+    _settings = (level, window_bits, mem_level)
+    METRICS.gauge("compression", _ratio)
+    return ServerPerMessageDeflateFactory(
+        server_max_window_bits=window_bits,
+        client_max_window_bits=window_bits,
+        compress_settings={"level": level, "memLevel": mem_level},
+    )
+
+
+def sample(data: str | bytes) -> None:
+    """Called for every frame sent; compresses one in SAMPLE_EVERY"""
+    global _frames
+    if _settings is None:
+        return
+    _frames += 1
+    if _frames % SAMPLE_EVERY:
+        return
+    level, window_bits, mem_level = _settings
+    raw = data.encode("utf-8") if isinstance(data, str) else data
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits, mem_level)
+    METRICS.count("compression.sampled_bytes", len(raw))
+    METRICS.count("compression.sampled_compressed", len(compressor.compress(raw) + compressor.flush(zlib.Z_SYNC_FLUSH)))
+
+
+def _ratio() -> dict:
+    raw = METRICS.counters.get("compression.sampled_bytes", 0)
+    compressed = METRICS.counters.get("compression.sampled_compressed", 0)
+    level, window_bits, mem_level = _settings
+    return {
+        "level": level,
+        "window_bits": window_bits,
+        "mem_level": mem_level,
+        "ratio": compressed / raw if raw else None,
+    }
@@ -0,0 +1,250 @@
+"""
+Headless load generator for the websocket server.
+
+Spawns many simulated clients speaking the same protocol as OnlineManager. Each one
+walks tile by tile over the walkable tiles of a real map and chats now and then. At the
+end it reports how steadily player frames arrive, broadcast latency, traffic and server
+CPU. The server should run on the same machine: latency compares the server's frame
+timestamp with the local clock.
+
+    python -m server.loadTest --clients 500 --duration 30 --spawn-server
+    python -m server.loadTest --clients 2000 --codec binary --server-pid 12345
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pytmx
+import websockets
+
+from server import wireCodec
+
+TILE_SIZE = 64
+MAPS_DIR = Path("assets/maps")
+
+
+def load_walkable(path: Path) -> list[tuple[int, int]]:
+    """Walkable tiles of a TMX map, using the same collision layers as Map"""
+    tmx = pytmx.TiledMap(str(path))
+    blocked = set()
+    for layer in tmx.visible_layers:
+        if isinstance(layer, pytmx.TiledTileLayer) and ("collision" in layer.name.lower() or "house" in layer.name.lower()):
+            for x, y, gid in layer:
+                if gid != 0:
+                    blocked.add((x, y))
+    return [(x, y) for x in range(tmx.width) for y in range(tmx.height) if (x, y) not in blocked]
+
+
+def percentiles(values: list[float], points=(50, 95, 99)) -> str:
+    if not values:
+        return "n/a"
+    ordered = sorted(values)
+    parts = []
+    for p in points:
+        i = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        parts.append(f"p{p}={ordered[i]:.1f}")
+    return " ".join(parts)
+
+
+def process_cpu_seconds(pid: int) -> float | None:
+    """User + system CPU time of a process (Linux /proc only)"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+@dataclass
+class Stats:
+    connected: int = 0
+    failed: int = 0
+    frames: int = 0
+    chat_frames: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    # Milliseconds between consecutive player frames on one client
+    intervals: list[float] = field(default_factory=list)
+    # Milliseconds between the server stamping a frame and the client receiving it
+    latencies: list[float] = field(default_factory=list)
+
+
+class SimClient:
+    """One simulated player"""
+
+    def __init__(self, url: str, map_name: str, walkable: list[tuple[int, int]], args, stats: Stats):
+        self.url = url
+        self.map_name = map_name
+        self.walkable = walkable
+        self.walkable_set = set(walkable)
+        self.args = args
+        self.stats = stats
+        self.codec = wireCodec.CODEC_JSON
+        self.maps_in = wireCodec.MapTable()
+        self.maps_out = wireCodec.MapTable()
+        self.maps_defined: set[int] = set()
+        self.tile = random.choice(walkable)
+        self.last_frame = 0.0
+
+    async def run(self, stop: asyncio.Event) -> None:
+        try:
+            compression = "deflate" if self.args.compression == "deflate" else None
+            async with websockets.connect(self.url, ping_interval=None, compression=compression) as ws:
+                self.stats.connected += 1
+                if self.args.codec == wireCodec.CODEC_BINARY or self.args.batch:
+                    await self._send(ws, json.dumps({"type": "hello", "codecs": [self.args.codec],
+                                                     "batch": self.args.batch}))
+                reader = asyncio.create_task(self._read(ws))
+                try:
+                    await self._act(ws, stop)
+                finally:
+                    reader.cancel()
+        except (OSError, websockets.exceptions.WebSocketException):
+            self.stats.failed += 1
+
+    async def _send(self, ws, data: str | bytes) -> None:
+        self.stats.bytes_out += len(data)
+        await ws.send(data)
+
+    async def _act(self, ws, stop: asyncio.Event) -> None:
+        send_interval = 1.0 / self.args.send_rate
+        step_time = 1.0 / self.args.walk_speed
+        chat_chance = self.args.chat_rate / 60.0 * send_interval
+        x, y = self.tile[0] * TILE_SIZE, self.tile[1] * TILE_SIZE
+        target = self.tile
+        progress = step_time
+        while not stop.is_set():
+            # Walk towards the next tile, pick a new walkable neighbour when arrived
+            progress += send_interval
+            if progress >= step_time:
+                self.tile = target
+                neighbours = [(self.tile[0] + dx, self.tile[1] + dy) for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1))]
+                options = [n for n in neighbours if n in self.walkable_set]
+                target = random.choice(options) if options else self.tile
+                progress = 0.0
+            t = progress / step_time
+            x = (self.tile[0] + (target[0] - self.tile[0]) * t) * TILE_SIZE
+            y = (self.tile[1] + (target[1] - self.tile[1]) * t) * TILE_SIZE
+            await self._send_position(ws, x, y)
+            if random.random() < chat_chance:
+                await self._send(ws, json.dumps({"type": "chat_send", "text": f"load test {random.randint(0, 9999)}"}))
+            await asyncio.sleep(send_interval)
+
+    async def _send_position(self, ws, x: float, y: float) -> None:
+        if self.codec == wireCodec.CODEC_BINARY:
+            map_id = self.maps_out.id_for(self.map_name)
+            if map_id not in self.maps_defined:
+                self.maps_defined.add(map_id)
+                await self._send(ws, wireCodec.encode_map_define(map_id, self.map_name))
+            await self._send(ws, wireCodec.encode_player_update(x, y, map_id, "down", True))
+        else:
+            await self._send(ws, json.dumps({"type": "player_update", "x": x, "y": y, "map": self.map_name}))
+
+    async def _read(self, ws) -> None:
+        async for message in ws:
+            now = time.time()
+            self.stats.bytes_in += len(message)
+            if isinstance(message, bytes):
+                data = wireCodec.decode(message, self.maps_in)
+                if data is None:
+                    continue
+            else:
+                data = json.loads(message)
+            for part in data["messages"] if data.get("type") == "batch" else (data,):
+                self._count(part, now)
+
+    def _count(self, data: dict, now: float) -> None:
+        msg_type = data.get("type")
+        if msg_type == "codec":
+            self.codec = data.get("codec", wireCodec.CODEC_JSON)
+        elif msg_type in ("players_update", "players_delta"):
+            self.stats.frames += 1
+            self.stats.latencies.append((now - float(data.get("timestamp", now))) * 1000)
+            if self.last_frame:
+                self.stats.intervals.append((now - self.last_frame) * 1000)
+            self.last_frame = now
+        elif msg_type == "chat_update":
+            self.stats.chat_frames += 1
+
+
+async def run_load(args) -> None:
+    maps = {}
+    for name in args.maps:
+        maps[name] = load_walkable(MAPS_DIR / name)
+    server = None
+    server_pid = args.server_pid
+    if args.spawn_server:
+        # Cold start, leave the real server's snapshot file alone, and measure the server
+        # rather than its rate limiter (--server-args --rate-limit-scale 1 to keep it)
+        server = subprocess.Popen([sys.executable, "server.py", "--snapshot", "", "--rate-limit-scale", "0",
+                                   *args.server_args])
+        server_pid = server.pid
+        await asyncio.sleep(1.0)
+    stats = Stats()
+    stop = asyncio.Event()
+    clients = []
+    for i in range(args.clients):
+        name = args.maps[i % len(args.maps)]
+        clients.append(SimClient(args.url, name, maps[name], args, stats))
+    try:
+        tasks = []
+        for client in clients:
+            tasks.append(asyncio.create_task(client.run(stop)))
+            # Spread connects over the ramp time
+            await asyncio.sleep(args.ramp / max(args.clients, 1))
+        # Measure only once everybody is in
+        stats.frames = stats.chat_frames = stats.bytes_in = stats.bytes_out = 0
+        stats.intervals.clear()
+        stats.latencies.clear()
+        cpu_start = process_cpu_seconds(server_pid) if server_pid else None
+        started = time.monotonic()
+        await asyncio.sleep(args.duration)
+        elapsed = time.monotonic() - started
+        cpu_end = process_cpu_seconds(server_pid) if server_pid else None
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print(f"clients        : {stats.connected} connected, {stats.failed} failed")
+    print(f"player frames  : {stats.frames / elapsed:.0f}/s, chat frames {stats.chat_frames / elapsed:.0f}/s")
+    print(f"frame interval : {percentiles(stats.intervals)} ms")
+    print(f"latency        : {percentiles(stats.latencies)} ms")
+    print(f"traffic        : in {stats.bytes_in / elapsed / 1024:.1f} KiB/s, out {stats.bytes_out / elapsed / 1024:.1f} KiB/s")
+    if cpu_start is not None and cpu_end is not None:
+        print(f"server cpu     : {(cpu_end - cpu_start) / elapsed * 100:.1f}%")
+    else:
+        print("server cpu     : n/a (use --spawn-server or --server-pid on Linux)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test for the Monster Go websocket server")
+    parser.add_argument("--url", default="ws://localhost:8989")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds measured after ramp-up")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which clients connect")
+    parser.add_argument("--maps", nargs="+", default=sorted(p.name for p in MAPS_DIR.glob("*.tmx")))
+    parser.add_argument("--codec", choices=[wireCodec.CODEC_JSON, wireCodec.CODEC_BINARY], default=wireCodec.CODEC_JSON)
+    parser.add_argument("--batch", action="store_true", help="ask for one frame per tick")
+    parser.add_argument("--compression", choices=["deflate", "off"], default="deflate")
+    parser.add_argument("--send-rate", type=float, default=60.0, help="position updates per second per client")
+    parser.add_argument("--walk-speed", type=float, default=4.0, help="tiles per second")
+    parser.add_argument("--chat-rate", type=float, default=1.0, help="chat messages per minute per client")
+    parser.add_argument("--spawn-server", action="store_true", help="start server.py locally for the run")
+    parser.add_argument("--server-args", nargs=argparse.REMAINDER, default=[], help="extra arguments for server.py")
+    parser.add_argument("--server-pid", type=int, default=None, help="pid of a running server, for CPU usage")
+    asyncio.run(run_load(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
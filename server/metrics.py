@@ -0,0 +1,176 @@
+"""
+Live server counters and a small admin HTTP endpoint (localhost only).
+
+    curl localhost:8990/metrics             counters, rates and histograms as JSON
+    curl localhost:8990/profile?seconds=5   sampled profile of the event loop thread
+
+Recording is a dict increment or a bisect into fixed buckets, so it stays on under load.
+The profiler only runs while a /profile request is waiting on it.
+"""
+import asyncio
+import bisect
+import collections
+import json
+import sys
+import threading
+import time
+from typing import Callable, Dict
+from urllib.parse import parse_qs, urlsplit
+
+# Histogram bucket upper bounds in milliseconds (last bucket is open ended)
+BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 16.7, 25.0, 50.0, 100.0, 250.0, 1000.0)
+PROFILE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 60.0
+
+
+class Histogram:
+    """Fixed-bucket histogram of durations in milliseconds"""
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect.bisect_left(BUCKETS_MS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p: float) -> float:
+        """Upper bound of the bucket holding the p-th percentile"""
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class Metrics:
+    """Process-wide counters, timing histograms and gauges read on demand"""
+    counters: Dict[str, int]
+    histograms: Dict[str, Histogram]
+    # Gauges are computed when metrics are read, not on every change
+    gauges: Dict[str, Callable[[], object]]
+
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.counters = collections.defaultdict(int)
+        self.histograms = collections.defaultdict(Histogram)
+        self.gauges = {}
+        # Counter values at the previous read, for rates
+        self._last_read = self.started
+        self._last_counters: Dict[str, int] = {}
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+
+    def observe(self, name: str, ms: float) -> None:
+        self.histograms[name].observe(ms)
+
+    def gauge(self, name: str, read: Callable[[], object]) -> None:
+        self.gauges[name] = read
+
+    def snapshot(self) -> dict:
+        """Everything as a JSON-friendly dict; rates are per second since the previous read"""
+        now = time.monotonic()
+        elapsed = max(now - self._last_read, 1e-9)
+        counters = dict(self.counters)
+        rates = {name: (value - self._last_counters.get(name, 0)) / elapsed for name, value in counters.items()}
+        self._last_read = now
+        self._last_counters = counters
+        return {
+            "uptime": now - self.started,
+            "counters": counters,
+            "rates": rates,
+            "histograms_ms": {name: h.to_dict() for name, h in self.histograms.items()},
+            "gauges": {name: read() for name, read in self.gauges.items()},
+        }
+
+
+METRICS = Metrics()
+
+
+def sample_profile(thread_id: int, seconds: float, interval: float = PROFILE_INTERVAL) -> str:
+    """
+    Sample the stack of one thread for `seconds` and return the hottest functions.
+    Runs in its own thread so it can watch the event loop thread from outside.
+    """
+    self_counts: collections.Counter = collections.Counter()
+    total_counts: collections.Counter = collections.Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples += 1
+            self_counts[_frame_name(frame)] += 1
+            seen = set()
+            while frame is not None:
+                name = _frame_name(frame)
+                if name not in seen:
+                    seen.add(name)
+                    total_counts[name] += 1
+                frame = frame.f_back
+        time.sleep(interval)
+    lines = [f"{samples} samples over {seconds:.1f}s", "", "self%   total%  function"]
+    for name, n in self_counts.most_common(30):
+        lines.append(f"{n * 100 / samples:5.1f}  {total_counts[name] * 100 / samples:6.1f}   {name}")
+    return "\n".join(lines) + "\n"
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+async def serve_admin(host: str, port: int) -> asyncio.Server:
+    """Start the admin endpoint; profiles sample the thread running this loop"""
+    loop_thread = threading.get_ident()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await reader.readline()
+            # Skip the headers, nothing in them matters here
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.decode("latin-1").split()
+            url = urlsplit(parts[1] if len(parts) > 1 else "/")
+            status, content_type = "200 OK", "application/json"
+            if url.path == "/metrics":
+                body = json.dumps(METRICS.snapshot(), indent=2)
+            elif url.path == "/profile":
+                query = parse_qs(url.query)
+                seconds = min(float(query.get("seconds", ["5"])[0]), MAX_PROFILE_SECONDS)
+                body = await asyncio.to_thread(sample_profile, loop_thread, seconds)
+                content_type = "text/plain"
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "try /metrics or /profile?seconds=5\n"
+            data = body.encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1") + data
+            )
+            await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
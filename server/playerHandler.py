@@ -1,11 +1,28 @@
-import threading
+import asyncio
+import heapq
+import math
 import time
-import copy
-from dataclasses import dataclass
-from typing import Dict, Optional
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional, Set
+
+from server.metrics import METRICS
 
 TIMEOUT_TIME = 60.0
 CHECK_INTERVAL_TIME = 10.0
+# Positions further out than this (in pixels) are rejected
+MAX_COORDINATE = 1_000_000.0
+
+# Spatial hash: players are bucketed into square cells of GRID_CELL_TILES tiles
+TILE_SIZE = 64
+GRID_CELL_TILES = 8
+GRID_CELL_SIZE = TILE_SIZE * GRID_CELL_TILES
+
+Cell = tuple[int, int]
+
+
+def cell_of(x: float, y: float) -> Cell:
+    return (int(x // GRID_CELL_SIZE), int(y // GRID_CELL_SIZE))
+
 
 @dataclass
 class Player:
@@ -14,84 +31,280 @@ class Player:
     y: float
     map: str
     last_update: float
+    dir: str = "down"
+    moving: bool = False
+    # Handler version at which this player last changed
+    version: int = 0
+    # Spatial hash cell the player is currently bucketed in
+    cell: Cell = (0, 0)
+    # Wire record cached for `version`
+    _record: Optional[dict] = field(default=None, repr=False, compare=False)
+    _record_version: int = field(default=-1, repr=False, compare=False)
 
-    def update(self, x: float, y: float, map: str) -> None:
+    def update(self, x: float, y: float, map: str, dir: str, moving: bool) -> bool:
+        """Apply a new state, return True if anything visible changed"""
         if x != self.x or y != self.y or map != self.map:
             self.last_update = time.monotonic()
+        changed = (
+            x != self.x or y != self.y or map != self.map
+            or dir != self.dir or moving != self.moving
+        )
         self.x = x
         self.y = y
         self.map = map
+        self.dir = dir
+        self.moving = moving
+        return changed
 
     def is_inactive(self) -> bool:
         now = time.monotonic()
         return (now - self.last_update) >= TIMEOUT_TIME
 
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "x": self.x,
+            "y": self.y,
+            "map": self.map,
+            "dir": self.dir,
+            "moving": self.moving,
+        }
+
+    def record(self) -> dict:
+        """to_dict() built once per version; shared, so callers must not modify it"""
+        if self._record_version != self.version:
+            self._record = self.to_dict()
+            self._record_version = self.version
+        return self._record
+
 
 class PlayerHandler:
-    _lock: threading.Lock
-    _stop_event: threading.Event
-    _thread: threading.Thread | None
-    
+    """
+    Player registry owned by the server's event loop.
+    Every method is called from the loop thread, so no locking is needed.
+    """
+    _sweeper: asyncio.Task | None
+    # Players with a live connection are never timed out, only idle leftovers are
+    _is_connected: Callable[[int], bool] | None
+
     players: Dict[int, Player]
     _next_id: int
+    # Bumped on every register / update / removal
+    _version: int
+    # Tombstones: (player id, map it left) -> version it was removed at
+    _removed: Dict[tuple[int, str], int]
+    # Per-map spatial hash: map -> cell -> player ids
+    _grid: Dict[str, Dict[Cell, Set[int]]]
+    # Timeout heap of (deadline, player id); entries may be stale, see _sweep
+    _deadlines: list[tuple[float, int]]
+    # Snapshots cached for the version they were taken at
+    _snapshot: tuple[int, dict] | None
+    _snapshot_by_map: tuple[int, Dict[str, dict]] | None
+
+    def __init__(self, *, timeout_seconds: float = 120.0, check_interval_seconds: float = 5.0,
+                 is_connected: Callable[[int], bool] | None = None):
+        self._sweeper = None
+        self._is_connected = is_connected
 
-    def __init__(self, *, timeout_seconds: float = 120.0, check_interval_seconds: float = 5.0):
-        self._lock = threading.Lock()
-        self._stop_event = threading.Event()
-        self._thread = None
-        
         self.players = {}
         self._next_id = 0
-        
-    # Threading
+        self._version = 0
+        self._removed = {}
+        self._grid = {}
+        self._deadlines = []
+        self._snapshot = None
+        self._snapshot_by_map = None
+
+    # Timeout sweeping
     def start(self) -> None:
-        if self._thread and self._thread.is_alive():
+        """Start the timeout sweeper; must be called from the running event loop"""
+        if self._sweeper and not self._sweeper.done():
             return
-        self._stop_event.clear()
-        self._thread = threading.Thread(target=self._cleaner, name="PlayerCleaner", daemon=True)
-        self._thread.start()
+        self._sweeper = asyncio.create_task(self._sweep())
 
     def stop(self) -> None:
-        self._stop_event.set()
-        if self._thread:
-            self._thread.join(timeout=2.0)
+        if self._sweeper:
+            self._sweeper.cancel()
+            self._sweeper = None
 
-    def _cleaner(self) -> None:
-        while not self._stop_event.wait(CHECK_INTERVAL_TIME):
+    async def _sweep(self) -> None:
+        while True:
             now = time.monotonic()
-            to_remove: list[int] = []
-            with self._lock:
-                for pid, p in list(self.players.items()):
-                    if now - p.last_update >= TIMEOUT_TIME:
-                        to_remove.append(pid)
-                for pid in to_remove:
-                    _ = self.players.pop(pid, None)
-                    
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, pid = heapq.heappop(self._deadlines)
+                p = self.players.get(pid)
+                if p is None:
+                    continue
+                deadline = p.last_update + TIMEOUT_TIME
+                if deadline <= now and self._is_connected is not None and self._is_connected(pid):
+                    # Standing still but still connected: keep it, check again later
+                    heapq.heappush(self._deadlines, (now + TIMEOUT_TIME, pid))
+                elif deadline <= now:
+                    self._remove(pid)
+                    METRICS.count("sweeper.removed")
+                else:
+                    # Player moved since this entry was pushed: wait for its real deadline
+                    heapq.heappush(self._deadlines, (deadline, pid))
+            # New entries always expire after the current head, so sleeping until it is enough
+            delay = self._deadlines[0][0] - now if self._deadlines else CHECK_INTERVAL_TIME
+            await asyncio.sleep(min(delay, CHECK_INTERVAL_TIME))
+
+    def _remove(self, pid: int) -> bool:
+        p = self.players.pop(pid, None)
+        if p is None:
+            return False
+        self._grid_remove(p)
+        self._version += 1
+        self._removed[(pid, p.map)] = self._version
+        return True
+
     # API
-    def register(self) -> int:
-        with self._lock:
+    def register(self, pid: int | None = None) -> int:
+        """Add a player; `pid` lets a sharded front process hand out the ids itself"""
+        if pid is None:
             pid = self._next_id
-            self._next_id += 1
-            self.players[pid] = Player(pid, 0.0, 0.0, "", time.monotonic())
-            return pid
+        self._next_id = max(self._next_id, pid + 1)
+        self._version += 1
+        p = Player(pid, 0.0, 0.0, "", time.monotonic(), version=self._version)
+        self.players[pid] = p
+        self._grid_add(p)
+        heapq.heappush(self._deadlines, (p.last_update + TIMEOUT_TIME, pid))
+        return pid
+
+    def unregister(self, pid: int) -> bool:
+        return self._remove(pid)
+
+    def update(self, pid: int, x: float, y: float, map_name: str,
+               dir_name: str = "down", moving: bool = False) -> bool:
+        p = self.players.get(pid)
+        if not p:
+            return False
+        x, y = float(x), float(y)
+        if not (math.isfinite(x) and math.isfinite(y)) or abs(x) > MAX_COORDINATE or abs(y) > MAX_COORDINATE:
+            # Would break the spatial hash (and every tick after it)
+            return False
+        old_map = p.map
+        if p.update(x, y, str(map_name), str(dir_name), bool(moving)):
+            self._version += 1
+            p.version = self._version
+            if old_map != p.map:
+                # Players on the old map must see this one leave
+                self._removed[(pid, old_map)] = self._version
+            new_cell = cell_of(p.x, p.y)
+            if old_map != p.map or new_cell != p.cell:
+                self._grid_remove(p, old_map)
+                p.cell = new_cell
+                self._grid_add(p)
+        return True
 
-    def update(self, pid: int, x: float, y: float, map_name: str) -> bool:
-        with self._lock:
+    # Spatial hash
+    def _grid_add(self, p: Player) -> None:
+        self._grid.setdefault(p.map, {}).setdefault(p.cell, set()).add(p.id)
+
+    def _grid_remove(self, p: Player, map_name: str | None = None) -> None:
+        map_name = p.map if map_name is None else map_name
+        cells = self._grid.get(map_name)
+        if cells is None:
+            return
+        bucket = cells.get(p.cell)
+        if bucket is None:
+            return
+        bucket.discard(p.id)
+        if not bucket:
+            del cells[p.cell]
+            if not cells:
+                del self._grid[map_name]
+
+    def nearby(self, pid: int, radius: float) -> Set[int]:
+        """Ids of players on the same map as `pid` within `radius` pixels of it"""
+        me = self.players.get(pid)
+        if me is None:
+            return set()
+        cells = self._grid.get(me.map)
+        if not cells:
+            return set()
+        cx0, cy0 = cell_of(me.x - radius, me.y - radius)
+        cx1, cy1 = cell_of(me.x + radius, me.y + radius)
+        r2 = radius * radius
+        out: Set[int] = set()
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                for other in cells.get((cx, cy), ()):
+                    p = self.players[other]
+                    dx = p.x - me.x
+                    dy = p.y - me.y
+                    if dx * dx + dy * dy <= r2:
+                        out.add(other)
+        return out
+
+    def get_players(self, pids) -> dict:
+        """Player records for the given ids, skipping ones that are gone"""
+        out = {}
+        for pid in pids:
             p = self.players.get(pid)
-            if not p:
-                return False
-            else:
-                p.update(float(x), float(y), str(map_name))
-                return True
+            if p is not None:
+                out[pid] = p.record()
+        return out
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def next_id(self) -> int:
+        return self._next_id
+
+    def reserve_ids(self, next_id: int) -> None:
+        """Never hand out ids below `next_id` (ids from before a restart may come back)"""
+        self._next_id = max(self._next_id, next_id)
 
     def list_players(self) -> dict:
-        with self._lock:
-            player_list = {}
+        return self.snapshot()[0]
+
+    def snapshot(self) -> tuple[dict, int]:
+        """
+        Full player list together with the version it was taken at.
+        Cached until the next change, so the returned dict must not be modified.
+        """
+        if self._snapshot is None or self._snapshot[0] != self._version:
+            self._snapshot = (self._version, {p.id: p.record() for p in self.players.values()})
+        return self._snapshot[1], self._version
+
+    def snapshot_by_map(self) -> tuple[Dict[str, dict], int]:
+        """Full player list grouped by map (cached like snapshot), with its version"""
+        if self._snapshot_by_map is None or self._snapshot_by_map[0] != self._version:
+            groups: Dict[str, dict] = {}
             for p in self.players.values():
-                player_list[p.id] = {
-                    "id": p.id,
-                    "x": p.x,
-                    "y": p.y,
-                    "map": p.map
-                }
-            return player_list
+                groups.setdefault(p.map, {})[p.id] = p.record()
+            self._snapshot_by_map = (self._version, groups)
+        return self._snapshot_by_map[1], self._version
+
+    def changes_since(self, version: int) -> tuple[dict, list[int], int]:
+        """Players changed and ids removed after `version`, plus the current version"""
+        changed = {}
+        for p in self.players.values():
+            if p.version > version:
+                changed[p.id] = p.record()
+        removed = [pid for (pid, _), v in self._removed.items() if v > version]
+        return changed, removed, self._version
+
+    def changes_by_map(self, version: int) -> tuple[Dict[str, tuple[dict, list[int]]], int]:
+        """Same as changes_since, grouped by map: map -> (changed players, removed ids)"""
+        groups: Dict[str, tuple[dict, list[int]]] = {}
+        if version == self._version:
+            # Nothing happened since the last call
+            return groups, self._version
+        for p in self.players.values():
+            if p.version > version:
+                groups.setdefault(p.map, ({}, []))[0][p.id] = p.record()
+        for (pid, map_name), v in self._removed.items():
+            if v > version:
+                groups.setdefault(map_name, ({}, []))[1].append(pid)
+        return groups, self._version
+
+    def forget_removed(self, version: int) -> None:
+        """Drop tombstones every consumer has already seen"""
+        if not self._removed:
+            return
+        for key in [key for key, v in self._removed.items() if v <= version]:
+            del self._removed[key]
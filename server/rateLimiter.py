@@ -0,0 +1,79 @@
+import time
+from typing import Dict
+
+# Messages per second and burst size per message type.
+# "*" is checked for every frame before it is even parsed.
+RATE_LIMITS: Dict[str, tuple[float, float]] = {
+    "*": (240.0, 120.0),
+    "player_update": (60.0, 30.0),
+    "chat_send": (2.0, 5.0),
+    "hello": (1.0, 3.0),
+    "error": (10.0, 10.0),
+}
+# Kinds without an entry above share one bucket with this limit
+DEFAULT_LIMIT = (10.0, 10.0)
+_OTHER = "?"
+# Off only for benchmarks, see scale_limits
+ENABLED = True
+
+
+def scale_limits(factor: float) -> None:
+    """Multiply every rate and burst by `factor` (0 = no limits), e.g. for sped-up replays"""
+    global DEFAULT_LIMIT, ENABLED
+    ENABLED = factor > 0
+    if not ENABLED:
+        return
+    for kind, (rate, burst) in RATE_LIMITS.items():
+        RATE_LIMITS[kind] = (rate * factor, burst * factor)
+    DEFAULT_LIMIT = (DEFAULT_LIMIT[0] * factor, DEFAULT_LIMIT[1] * factor)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self) -> bool:
+        """Use up one token if there is one"""
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+    def wait_time(self) -> float:
+        """Seconds until the next token"""
+        self._refill(time.monotonic())
+        return max(0.0, (1.0 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Token buckets of one connection, created per limited kind on first use"""
+    _buckets: Dict[str, TokenBucket]
+
+    def __init__(self, limits: Dict[str, tuple[float, float]] = RATE_LIMITS) -> None:
+        self._limits = limits
+        self._buckets = {}
+
+    def bucket(self, kind: str) -> TokenBucket:
+        if kind not in self._limits:
+            # Never one bucket per client-chosen string
+            kind = _OTHER
+        bucket = self._buckets.get(kind)
+        if bucket is None:
+            bucket = self._buckets[kind] = TokenBucket(*self._limits.get(kind, DEFAULT_LIMIT))
+        return bucket
+
+    def allow(self, kind: str) -> bool:
+        if not ENABLED:
+            return True
+        return self.bucket(kind).take()
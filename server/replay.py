@@ -0,0 +1,162 @@
+"""
+Replays a traffic capture (python server.py --capture FILE) against a server.
+
+Every captured connection is opened again at its original time and sends its frames with
+the original spacing, divided by --speed (0 = as fast as possible). Resume tokens from the
+capture mean nothing to a fresh server and are dropped. Reports the same numbers as the
+load tester, plus how far the replay fell behind its schedule.
+
+    python server.py --capture traffic.cap        # record a real session
+    python -m server.replay traffic.cap --speed 10 --spawn-server
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import websockets
+
+from server import wireCodec
+from server.loadTest import Stats, percentiles, process_cpu_seconds
+from server.trafficLog import KIND_BINARY, KIND_CONNECT, KIND_DISCONNECT, read_records
+
+
+def load_connections(path: str) -> dict[int, list[tuple[float, int, bytes]]]:
+    """Captured records grouped by connection, in order"""
+    connections: dict[int, list[tuple[float, int, bytes]]] = {}
+    for t, conn_id, kind, payload in read_records(path):
+        connections.setdefault(conn_id, []).append((t, kind, payload))
+    return connections
+
+
+def replay_path(path: str) -> str:
+    query = parse_qs(urlsplit(path).query)
+    query.pop("resume", None)
+    return "/?" + urlencode(query, doseq=True) if query else "/"
+
+
+async def read_frames(ws, stats: Stats) -> None:
+    maps = wireCodec.MapTable()
+    last_frame = 0.0
+    async for message in ws:
+        now = time.time()
+        stats.bytes_in += len(message)
+        if isinstance(message, bytes):
+            data = wireCodec.decode(message, maps)
+            if data is None:
+                continue
+        else:
+            data = json.loads(message)
+        for part in data["messages"] if data.get("type") == "batch" else (data,):
+            msg_type = part.get("type")
+            if msg_type in ("players_update", "players_delta"):
+                stats.frames += 1
+                stats.latencies.append((now - float(part.get("timestamp", now))) * 1000)
+                if last_frame:
+                    stats.intervals.append((now - last_frame) * 1000)
+                last_frame = now
+            elif msg_type == "chat_update":
+                stats.chat_frames += 1
+
+
+async def replay_connection(url: str, records: list, speed: float, started: float,
+                            stats: Stats, lag: list[float]) -> int:
+    """Re-drive one captured connection; returns the number of frames sent"""
+    loop = asyncio.get_running_loop()
+    sent = 0
+
+    async def wait_until(t: float) -> None:
+        if speed > 0:
+            delay = started + t / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                lag.append(-delay * 1000)
+
+    t0, kind, payload = records[0]
+    if kind != KIND_CONNECT:
+        return 0
+    await wait_until(t0)
+    try:
+        async with websockets.connect(url.rstrip("/") + replay_path(payload.decode("utf-8")),
+                                      ping_interval=None) as ws:
+            stats.connected += 1
+            reader = asyncio.create_task(read_frames(ws, stats))
+            try:
+                for t, kind, payload in records[1:]:
+                    await wait_until(t)
+                    if kind == KIND_DISCONNECT:
+                        break
+                    data = payload if kind == KIND_BINARY else payload.decode("utf-8")
+                    stats.bytes_out += len(payload)
+                    await ws.send(data)
+                    sent += 1
+                    if speed <= 0:
+                        # Let the reader run now and then at max speed
+                        await asyncio.sleep(0)
+            finally:
+                reader.cancel()
+    except (OSError, websockets.exceptions.WebSocketException):
+        stats.failed += 1
+    return sent
+
+
+async def run_replay(args) -> None:
+    connections = load_connections(args.capture)
+    duration = max((records[-1][0] for records in connections.values()), default=0.0)
+    server = None
+    server_pid = args.server_pid
+    if args.spawn_server:
+        # Rate limits follow the replay speed, so the run doesn't just measure the limiter
+        server = subprocess.Popen([sys.executable, "server.py", "--snapshot", "",
+                                   "--rate-limit-scale", str(max(args.speed, 1.0) if args.speed else 0),
+                                   *args.server_args])
+        server_pid = server.pid
+        await asyncio.sleep(1.0)
+    stats = Stats()
+    lag: list[float] = []
+    try:
+        loop = asyncio.get_running_loop()
+        cpu_start = process_cpu_seconds(server_pid) if server_pid else None
+        started = loop.time()
+        sent = await asyncio.gather(*(
+            replay_connection(args.url, records, args.speed, started, stats, lag)
+            for records in connections.values() if records[0][1] == KIND_CONNECT
+        ))
+        elapsed = loop.time() - started
+        cpu_end = process_cpu_seconds(server_pid) if server_pid else None
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    frames_sent = sum(sent)
+    speed = "max" if args.speed <= 0 else f"{args.speed:g}x"
+    print(f"capture        : {len(connections)} connections, {duration:.1f}s, replayed at {speed} in {elapsed:.1f}s")
+    print(f"clients        : {stats.connected} connected, {stats.failed} failed")
+    print(f"sent           : {frames_sent} frames, {frames_sent / elapsed:.0f}/s")
+    print(f"player frames  : {stats.frames / elapsed:.0f}/s, chat frames {stats.chat_frames / elapsed:.0f}/s")
+    print(f"frame interval : {percentiles(stats.intervals)} ms")
+    print(f"latency        : {percentiles(stats.latencies)} ms")
+    print(f"schedule lag   : {percentiles(lag)} ms over {len(lag)} late sends")
+    print(f"traffic        : in {stats.bytes_in / elapsed / 1024:.1f} KiB/s, out {stats.bytes_out / elapsed / 1024:.1f} KiB/s")
+    if cpu_start is not None and cpu_end is not None:
+        print(f"server cpu     : {(cpu_end - cpu_start) / elapsed * 100:.1f}%")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay captured Monster Go server traffic")
+    parser.add_argument("capture", help="file written by server.py --capture")
+    parser.add_argument("--url", default="ws://localhost:8989")
+    parser.add_argument("--speed", type=float, default=1.0, help="time scale, e.g. 1 or 10 (0 = max)")
+    parser.add_argument("--spawn-server", action="store_true", help="start server.py locally for the run")
+    parser.add_argument("--server-args", nargs=argparse.REMAINDER, default=[], help="extra arguments for server.py")
+    parser.add_argument("--server-pid", type=int, default=None, help="pid of a running server, for CPU usage")
+    asyncio.run(run_replay(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
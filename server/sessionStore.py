@@ -0,0 +1,109 @@
+import secrets
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+# How long a disconnected player's id stays reserved for a resume
+RESUME_GRACE = 30.0
+
+
+@dataclass
+class Session:
+    player_id: int
+    # Connection currently using the session, None while disconnected
+    client: Any = None
+    # monotonic() deadline for a resume once disconnected
+    expires: float = 0.0
+    # Last player state of a disconnected session (kept on release or loaded from a
+    # snapshot), handed back on the next resume
+    restored: Optional[dict] = None
+
+
+class SessionStore:
+    """
+    Resume tokens handed out with `registered`. A client reconnecting with its token
+    gets its old player id back, also when the server has not noticed yet that the
+    old socket is dead: the new connection takes the session over.
+    """
+    _sessions: Dict[str, Session]
+    # Token of each connected client
+    _tokens: Dict[Any, str]
+    # Connected client of each player id
+    _clients: Dict[int, Any]
+
+    def __init__(self, grace: float = RESUME_GRACE) -> None:
+        self._grace = grace
+        self._sessions = {}
+        self._tokens = {}
+        self._clients = {}
+
+    def create(self, client: Any, player_id: int) -> str:
+        self._purge()
+        token = secrets.token_urlsafe(16)
+        self._sessions[token] = Session(player_id, client)
+        self._tokens[client] = token
+        self._clients[player_id] = client
+        return token
+
+    def resume(self, client: Any, token: str) -> tuple[Optional[int], Any]:
+        """
+        Hand the session to `client`. Returns its player id (None if unknown or expired)
+        and the connection it was taken from, if that one is still open.
+        """
+        self._purge()
+        session = self._sessions.get(token)
+        if session is None:
+            return None, None
+        previous = session.client
+        if previous is not None:
+            self._tokens.pop(previous, None)
+        session.client = client
+        self._tokens[client] = token
+        self._clients[session.player_id] = client
+        return session.player_id, previous
+
+    def take_restored(self, client: Any) -> Optional[dict]:
+        """Player state from before the disconnect, once, for a client that just resumed"""
+        token = self._tokens.get(client)
+        if token is None:
+            return None
+        session = self._sessions[token]
+        restored, session.restored = session.restored, None
+        return restored
+
+    def export(self) -> list[tuple[str, int, Optional[dict]]]:
+        """(token, player id, kept state) of every session (for snapshots)"""
+        return [(token, s.player_id, s.restored) for token, s in self._sessions.items()]
+
+    def restore(self, token: str, player_id: int, grace: float, state: Optional[dict] = None) -> None:
+        """Re-add a session from a snapshot as disconnected, resumable for `grace` seconds"""
+        self._sessions[token] = Session(player_id, expires=time.monotonic() + grace, restored=state)
+
+    def token_of(self, client: Any) -> Optional[str]:
+        return self._tokens.get(client)
+
+    def is_connected(self, player_id: int) -> bool:
+        return player_id in self._clients
+
+    def release(self, client: Any, state: Optional[dict] = None) -> bool:
+        """
+        Client disconnected: keep its session (and last `state`) around for a resume.
+        Returns False if the session was already taken over, in which case the player
+        id is still in use.
+        """
+        token = self._tokens.pop(client, None)
+        if token is None:
+            return False
+        session = self._sessions[token]
+        session.client = None
+        if self._clients.get(session.player_id) is client:
+            del self._clients[session.player_id]
+        session.restored = state
+        session.expires = time.monotonic() + self._grace
+        return True
+
+    def _purge(self) -> None:
+        now = time.monotonic()
+        expired = [t for t, s in self._sessions.items() if s.client is None and s.expires <= now]
+        for token in expired:
+            del self._sessions[token]
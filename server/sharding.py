@@ -0,0 +1,289 @@
+"""
+Sharded server mode (python server.py --shards N).
+
+The front process keeps the websockets, hands out player ids and runs chat; it acts as
+the broker between shards. Each map is owned by one worker process, which runs its own
+PlayerHandler and Broadcaster (registry, deltas, area of interest, encoding) for the
+players on its maps. Each worker connects back to the front over a loopback socket
+(asyncio streams, so it works on every platform's event loop) and sends length-prefixed
+pickles:
+
+    worker -> front: secret and shard index (raw bytes) once, then [(pid, encoded frame), ...] per tick
+    front -> worker: ("join", pid, codec) / ("update", pid, x, y, map, dir, moving)
+                     ("codec", pid, codec) / ("leave", pid)
+
+Writes never block either event loop. When one side stops reading and MAX_BUFFERED bytes
+pile up, position updates and tick frames are dropped (the worker then resends keyframes);
+join / leave / codec commands are always queued.
+
+When a teleport moves a player to a map owned by another shard, the front sends "leave"
+to the old shard and "join" to the new one, which then sends the player a keyframe.
+"""
+import asyncio
+import multiprocessing
+import pickle
+import secrets
+import struct
+import zlib
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from server.broadcaster import Broadcaster
+from server.clientConnection import ClientConnection
+from server.metrics import METRICS
+from server.playerHandler import PlayerHandler
+
+# Bytes allowed to wait in one direction before droppable messages are dropped
+MAX_BUFFERED = 4 << 20
+# How long the front waits for every worker to connect
+CONNECT_TIMEOUT = 30.0
+_FRAME = struct.Struct("<I")
+_HELLO_INDEX = struct.Struct("<H")
+
+
+class ShardLink:
+    """One end of the front <-> worker socket; sending never blocks the event loop"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    def backed_up(self) -> bool:
+        return self.writer.transport.get_write_buffer_size() > MAX_BUFFERED
+
+    def send(self, message) -> None:
+        if self.writer.is_closing():
+            return
+        data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        self.writer.write(_FRAME.pack(len(data)) + data)
+
+    async def recv(self):
+        (length,) = _FRAME.unpack(await self.reader.readexactly(_FRAME.size))
+        return pickle.loads(await self.reader.readexactly(length))
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+@dataclass(eq=False)
+class ShardClient(ClientConnection):
+    """Worker-side stand-in for a client: frames are collected for the front process"""
+    outbox: list = field(default_factory=list)
+
+    def start(self) -> None:
+        return
+
+    def stop(self) -> None:
+        self.closed = True
+
+    def send(self, data: str | bytes) -> bool:
+        if self.closed:
+            return False
+        self.outbox.append((self.player_id, data))
+        return True
+
+
+class ShardWorker:
+    """Runs inside a worker process: registry and broadcast tick for the maps of one shard"""
+
+    link: ShardLink
+
+    def __init__(self, port: int, secret: str, index: int, *, interval: float, idle_interval: float,
+                 delta_updates: bool, keyframe_interval: int, aoi_radius: float | None):
+        self.port = port
+        self.secret = secret
+        self.index = index
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.handler = PlayerHandler(is_connected=lambda pid: pid in self.clients)
+        self.broadcaster = Broadcaster(self.handler, delta_updates=delta_updates,
+                                       keyframe_interval=keyframe_interval, aoi_radius=aoi_radius)
+        self.clients: Dict[int, ShardClient] = {}
+        self.outbox: list = []
+
+    async def run(self) -> None:
+        self.link = ShardLink(*await asyncio.open_connection("127.0.0.1", self.port))
+        self.link.writer.write(self.secret.encode("ascii") + _HELLO_INDEX.pack(self.index))
+        self.handler.start()
+        ticker = asyncio.create_task(self.broadcaster.run(self.interval, self.idle_interval, self._flush))
+        try:
+            while True:
+                self._handle(*await self.link.recv())
+        except (asyncio.IncompleteReadError, OSError):
+            pass  # Front process is gone
+        finally:
+            ticker.cancel()
+
+    def _handle(self, cmd: str, pid: int, *args) -> None:
+        if cmd == "join":
+            client = ShardClient(None, player_id=pid, codec=args[0], outbox=self.outbox)
+            self.clients[pid] = client
+            self.handler.register(pid)
+            self.broadcaster.add(client)
+            return
+        client = self.clients.get(pid)
+        if client is None:
+            return
+        if cmd == "update":
+            x, y, map_name, dir_name, moving = args
+            self.handler.update(pid, x, y, map_name, dir_name, moving)
+            self.broadcaster.subscribe_map(client, map_name)
+            self.broadcaster.wake()
+        elif cmd == "codec":
+            client.codec = args[0]
+            self.broadcaster.request_keyframe(client)
+        elif cmd == "leave":
+            del self.clients[pid]
+            self.handler.unregister(pid)
+            self.broadcaster.drop({client})
+            self.broadcaster.wake()
+
+    def _flush(self) -> None:
+        if not self.outbox:
+            return
+        if self.link.backed_up():
+            # The front is not reading: skip this tick, and resync with keyframes once it is
+            for pid, _ in self.outbox:
+                client = self.clients.get(pid)
+                if client is not None:
+                    self.broadcaster.request_keyframe(client)
+        else:
+            self.link.send(self.outbox)
+        self.outbox.clear()
+
+
+def shard_main(port: int, secret: str, index: int, options: dict) -> None:
+    """Entry point of a worker process"""
+    try:
+        asyncio.run(ShardWorker(port, secret, index, **options).run())
+    except KeyboardInterrupt:
+        pass
+
+
+class ShardRouter:
+    """Front-process side: owns the worker processes and routes players to them by map"""
+
+    def __init__(self, shards: int, shard_maps: Dict[str, int], worker_options: dict):
+        self.shards = shards
+        self.shard_maps = shard_maps
+        self.worker_options = worker_options
+        self._links: list[Optional[ShardLink]] = [None] * shards
+        self._connected = asyncio.Event()
+        self._secret = secrets.token_hex(16)
+        self._processes: list[multiprocessing.Process] = []
+        self._clients: Dict[int, ClientConnection] = {}
+        self._client_shard: Dict[int, int] = {}
+        self._next_id = 0
+
+    async def start(self) -> None:
+        """Spawn the workers and wait until each has connected back"""
+        listener = await asyncio.start_server(self._on_worker, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        # Spawn rather than fork: the front already runs an event loop
+        ctx = multiprocessing.get_context("spawn")
+        for i in range(self.shards):
+            process = ctx.Process(target=shard_main, args=(port, self._secret, i, self.worker_options),
+                                  name=f"Shard-{i}", daemon=True)
+            process.start()
+            self._processes.append(process)
+        try:
+            await asyncio.wait_for(self._connected.wait(), CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"shard workers did not connect within {CONNECT_TIMEOUT:.0f}s") from None
+        finally:
+            listener.close()
+
+    def stop(self) -> None:
+        for link in self._links:
+            if link is not None:
+                link.close()
+        for process in self._processes:
+            process.join(timeout=2.0)
+
+    def shard_for(self, map_name: str) -> int:
+        shard = self.shard_maps.get(map_name)
+        if shard is None:
+            shard = zlib.crc32(map_name.encode("utf-8"))
+        return shard % self.shards
+
+    def _send(self, shard: int, *command) -> None:
+        link = self._links[shard]
+        if link is None:
+            return
+        if command[0] == "update" and link.backed_up():
+            # The worker is behind; a newer position will follow
+            METRICS.count("shard.dropped_updates")
+            return
+        link.send(command)
+
+    async def _on_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        link = ShardLink(reader, writer)
+        try:
+            # Checked before anything from the socket is unpickled
+            hello = await reader.readexactly(len(self._secret) + _HELLO_INDEX.size)
+            (shard,) = _HELLO_INDEX.unpack_from(hello, len(self._secret))
+            if (not secrets.compare_digest(hello[:len(self._secret)], self._secret.encode("ascii"))
+                    or shard >= self.shards or self._links[shard] is not None):
+                link.close()
+                return
+            self._links[shard] = link
+            if all(self._links):
+                self._connected.set()
+            while True:
+                for pid, data in await link.recv():
+                    client = self._clients.get(pid)
+                    if client is not None:
+                        client.send(data)
+        except (asyncio.IncompleteReadError, OSError, pickle.UnpicklingError, ValueError, TypeError):
+            link.close()
+        except asyncio.CancelledError:
+            # Server shutting down; start_server would log a cancelled handler as an error
+            link.close()
+
+    # Players
+    @property
+    def next_id(self) -> int:
+        return self._next_id
+
+    def reserve_ids(self, next_id: int) -> None:
+        self._next_id = max(self._next_id, next_id)
+
+    def register(self, client: ClientConnection, pid: int | None = None) -> int:
+        """Hand out a player id, or attach `client` to a resumed one"""
+        if pid is None:
+            pid = self._next_id
+        self._next_id = max(self._next_id, pid + 1)
+        shard = self._client_shard.pop(pid, None)
+        if shard is not None:
+            # Taken over from a connection that has not gone away yet: rejoin with a keyframe
+            self._send(shard, "leave", pid)
+        self._clients[pid] = client
+        return pid
+
+    def unregister(self, client: ClientConnection) -> None:
+        self._clients.pop(client.player_id, None)
+        shard = self._client_shard.pop(client.player_id, None)
+        if shard is not None:
+            self._send(shard, "leave", client.player_id)
+
+    def update(self, client: ClientConnection, x: float, y: float, map_name: str,
+               dir_name: str, moving: bool) -> None:
+        pid = client.player_id
+        shard: Optional[int] = self.shard_for(map_name) if map_name else None
+        current = self._client_shard.get(pid)
+        if shard != current:
+            # Hand the player over to the shard owning its new map
+            if current is not None:
+                self._send(current, "leave", pid)
+            if shard is not None:
+                self._send(shard, "join", pid, client.codec)
+                self._client_shard[pid] = shard
+            else:
+                self._client_shard.pop(pid, None)
+        if shard is not None:
+            self._send(shard, "update", pid, x, y, map_name, dir_name, moving)
+
+    def set_codec(self, client: ClientConnection) -> None:
+        shard = self._client_shard.get(client.player_id)
+        if shard is not None:
+            self._send(shard, "codec", client.player_id, client.codec)
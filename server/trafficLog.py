@@ -0,0 +1,69 @@
+"""
+Log of inbound server traffic, for replaying it later (see server/replay.py).
+
+One file holds one server run: connection ids and times restart with every run, so an
+existing capture is overwritten rather than appended to.
+
+Each record is a fixed header followed by its payload:
+
+    <d  seconds since the capture started
+    <I  connection id
+    <B  kind: connect (payload = request path), text, binary or disconnect
+    <I  payload length
+"""
+import struct
+import time
+from typing import BinaryIO, Iterator, Optional
+
+RECORD_HEADER = struct.Struct("<dIBI")
+
+KIND_CONNECT = 0
+KIND_TEXT = 1
+KIND_BINARY = 2
+KIND_DISCONNECT = 3
+
+
+class TrafficRecorder:
+    """Writes records from the server's event loop; buffered, flushed on close"""
+    _file: Optional[BinaryIO]
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "wb", buffering=1 << 16)
+        self._started = time.monotonic()
+
+    def _write(self, conn_id: int, kind: int, payload: bytes) -> None:
+        if self._file is None:
+            return
+        self._file.write(RECORD_HEADER.pack(time.monotonic() - self._started, conn_id, kind, len(payload)))
+        self._file.write(payload)
+
+    def connect(self, conn_id: int, path: str) -> None:
+        self._write(conn_id, KIND_CONNECT, path.encode("utf-8"))
+
+    def message(self, conn_id: int, data: str | bytes) -> None:
+        if isinstance(data, bytes):
+            self._write(conn_id, KIND_BINARY, data)
+        else:
+            self._write(conn_id, KIND_TEXT, data.encode("utf-8"))
+
+    def disconnect(self, conn_id: int) -> None:
+        self._write(conn_id, KIND_DISCONNECT, b"")
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_records(path: str) -> Iterator[tuple[float, int, int, bytes]]:
+    """(time, connection id, kind, payload) for every complete record in the file"""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            t, conn_id, kind, length = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return  # cut off mid-write
+            yield t, conn_id, kind, payload
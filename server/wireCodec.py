@@ -0,0 +1,182 @@
+"""
+Compact binary frames for player state.
+
+JSON stays the default; a client that sends {"type": "hello", "codecs": ["binary"]}
+gets {"type": "codec", "codec": "binary"} back, after which position updates and
+player lists travel as struct-packed binary frames in both directions. Map names
+are sent once per connection through MAP_DEFINE frames and referenced by id after.
+Chat and control messages stay JSON text.
+
+Clients that also send "batch": true in their hello get everything the server has for
+them in one tick as a single frame: a JSON "batch" message, or a binary BATCH frame
+when some of the parts are binary.
+
+This module only uses the standard library so both the server and the game client
+can import it.
+"""
+import json
+import struct
+
+CODEC_JSON = "json"
+CODEC_BINARY = "binary"
+
+FRAME_PLAYER_UPDATE = 1     # client -> server: own position
+FRAME_PLAYERS_UPDATE = 2    # server -> client: full player list (keyframe)
+FRAME_PLAYERS_DELTA = 3     # server -> client: changed players + removed ids
+FRAME_MAP_DEFINE = 4        # either way: map id -> map name
+FRAME_BATCH = 5             # server -> client: several frames of one tick
+
+DIRECTIONS = ("down", "up", "left", "right")
+_DIRECTION_IDS = {d: i for i, d in enumerate(DIRECTIONS)}
+
+# id, x, y, map id, direction, moving
+_RECORD = struct.Struct("<IffHBB")
+# kind, timestamp, player count
+_SNAPSHOT = struct.Struct("<BdH")
+# kind, timestamp, changed count, removed count
+_DELTA = struct.Struct("<BdHH")
+# kind, x, y, map id, direction, moving
+_POSITION = struct.Struct("<BffHBB")
+# kind, map id (utf-8 name follows)
+_MAP_DEFINE = struct.Struct("<BH")
+_REMOVED = struct.Struct("<I")
+# kind, timestamp, frame count; then per frame: is text, length
+_BATCH = struct.Struct("<BdH")
+_BATCH_ITEM = struct.Struct("<BI")
+# Map ids are 16 bit on the wire
+MAX_MAP_IDS = 1 << 16
+
+
+class MapTable:
+    """Map name <-> small integer id, one table per sending side, at most `limit` maps"""
+
+    def __init__(self, limit: int = MAX_MAP_IDS) -> None:
+        self.limit = limit
+        self._ids: dict[str, int] = {}
+        self._names: dict[int, str] = {}
+
+    def id_for(self, name: str) -> int:
+        map_id = self._ids.get(name)
+        if map_id is None:
+            map_id = len(self._ids)
+            self.define(map_id, name)
+        return map_id
+
+    def name_of(self, map_id: int) -> str:
+        return self._names.get(map_id, "")
+
+    def define(self, map_id: int, name: str) -> None:
+        old = self._names.get(map_id)
+        if old is None and len(self._names) >= self.limit:
+            raise ValueError("too many maps")
+        if old is not None and self._ids.get(old) == map_id:
+            # A redefined id forgets its old name, so resending one id can't grow the table
+            del self._ids[old]
+        self._ids[name] = map_id
+        self._names[map_id] = name
+
+
+def encode_map_define(map_id: int, name: str) -> bytes:
+    return _MAP_DEFINE.pack(FRAME_MAP_DEFINE, map_id) + name.encode("utf-8")
+
+
+def encode_player_update(x: float, y: float, map_id: int, dir_name: str = "down", moving: bool = False) -> bytes:
+    return _POSITION.pack(FRAME_PLAYER_UPDATE, x, y, map_id, _DIRECTION_IDS.get(dir_name, 0), bool(moving))
+
+
+def _pack_records(out: list[bytes], players: dict, maps: MapTable) -> None:
+    for p in players.values():
+        out.append(_RECORD.pack(
+            int(p["id"]), p["x"], p["y"], maps.id_for(p["map"]),
+            _DIRECTION_IDS.get(p.get("dir", "down"), 0), bool(p.get("moving", False)),
+        ))
+
+
+def encode_players(msg_type: str, players: dict, removed: list[int], timestamp: float, maps: MapTable) -> bytes:
+    """Binary form of a players_update / players_delta message"""
+    if msg_type == "players_update":
+        out = [_SNAPSHOT.pack(FRAME_PLAYERS_UPDATE, timestamp, len(players))]
+        _pack_records(out, players, maps)
+    else:
+        out = [_DELTA.pack(FRAME_PLAYERS_DELTA, timestamp, len(players), len(removed))]
+        _pack_records(out, players, maps)
+        out.extend(_REMOVED.pack(pid) for pid in removed)
+    return b"".join(out)
+
+
+def encode_batch(frames: list[str | bytes], timestamp: float) -> str | bytes:
+    """Pack the frames of one tick into a single frame, in order"""
+    if all(isinstance(f, str) for f in frames):
+        return f'{{"type": "batch", "timestamp": {timestamp!r}, "messages": [' + ", ".join(frames) + "]}"
+    out = [_BATCH.pack(FRAME_BATCH, timestamp, len(frames))]
+    for f in frames:
+        data = f.encode("utf-8") if isinstance(f, str) else f
+        out.append(_BATCH_ITEM.pack(isinstance(f, str), len(data)))
+        out.append(data)
+    return b"".join(out)
+
+
+def _unpack_records(frame: bytes, offset: int, count: int, maps: MapTable) -> dict:
+    players = {}
+    for pid, x, y, map_id, dir_id, moving in _RECORD.iter_unpack(frame[offset:offset + count * _RECORD.size]):
+        players[pid] = {
+            "id": pid,
+            "x": x,
+            "y": y,
+            "map": maps.name_of(map_id),
+            "dir": DIRECTIONS[dir_id] if dir_id < len(DIRECTIONS) else "down",
+            "moving": bool(moving),
+        }
+    return players
+
+
+def decode(frame: bytes, maps: MapTable) -> dict | None:
+    """
+    Decode a binary frame into the same dict shape as the JSON message.
+    MAP_DEFINE frames only update `maps` and return None.
+    """
+    kind = frame[0]
+    if kind == FRAME_MAP_DEFINE:
+        _, map_id = _MAP_DEFINE.unpack_from(frame)
+        maps.define(map_id, frame[_MAP_DEFINE.size:].decode("utf-8"))
+        return None
+    if kind == FRAME_PLAYER_UPDATE:
+        _, x, y, map_id, dir_id, moving = _POSITION.unpack(frame)
+        return {
+            "type": "player_update",
+            "x": x,
+            "y": y,
+            "map": maps.name_of(map_id),
+            "dir": DIRECTIONS[dir_id] if dir_id < len(DIRECTIONS) else "down",
+            "moving": bool(moving),
+        }
+    if kind == FRAME_PLAYERS_UPDATE:
+        _, timestamp, count = _SNAPSHOT.unpack_from(frame)
+        return {
+            "type": "players_update",
+            "players": _unpack_records(frame, _SNAPSHOT.size, count, maps),
+            "timestamp": timestamp,
+        }
+    if kind == FRAME_PLAYERS_DELTA:
+        _, timestamp, changed, removed = _DELTA.unpack_from(frame)
+        offset = _DELTA.size + changed * _RECORD.size
+        return {
+            "type": "players_delta",
+            "players": _unpack_records(frame, _DELTA.size, changed, maps),
+            "removed": [pid for (pid,) in _REMOVED.iter_unpack(frame[offset:offset + removed * _REMOVED.size])],
+            "timestamp": timestamp,
+        }
+    if kind == FRAME_BATCH:
+        _, timestamp, count = _BATCH.unpack_from(frame)
+        offset = _BATCH.size
+        messages = []
+        for _ in range(count):
+            is_text, length = _BATCH_ITEM.unpack_from(frame, offset)
+            offset += _BATCH_ITEM.size
+            data = frame[offset:offset + length]
+            offset += length
+            message = json.loads(data) if is_text else decode(data, maps)
+            if message is not None:
+                messages.append(message)
+        return {"type": "batch", "timestamp": timestamp, "messages": messages}
+    raise ValueError(f"unknown frame kind {kind}")
@@ -0,0 +1,122 @@
+"""
+Periodic on-disk snapshot of the server state, loaded again on startup.
+
+Holds the next player id, resumable sessions (with the player's last position, if this
+process knows it) and the chat history, as zlib-compressed JSON. Capturing only collects
+references to the cached player records and chat messages, which are never modified in
+place; serializing and writing happen in a worker thread and the file is replaced with an
+atomic rename, so the broadcast tick is not held up and a crash never leaves half a file.
+"""
+import asyncio
+import json
+import os
+import zlib
+from typing import Any, Optional
+
+from server.chatStore import ChatStore
+from server.sessionStore import SessionStore
+
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_INTERVAL = 10.0
+# Resume window for sessions loaded from a snapshot; clients reconnect with backoff
+RESTORE_GRACE = 120.0
+
+
+def capture(registry: Any, players: dict, chat: ChatStore, sessions: SessionStore) -> dict:
+    """State to save; cheap, runs on the event loop"""
+    messages, chat_next_id = chat.export()
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "next_player_id": registry.next_id,
+        # Connected players' current state, or the state a disconnected one left with
+        "sessions": [(token, pid, players.get(pid, kept)) for token, pid, kept in sessions.export()],
+        "chat": messages,
+        "chat_next_id": chat_next_id,
+    }
+
+
+def write(path: str, state: dict) -> int:
+    """Serialize and atomically replace the snapshot file; returns its size"""
+    data = zlib.compress(json.dumps(state, separators=(",", ":")).encode("utf-8"))
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return len(data)
+
+
+def read(path: str) -> Optional[dict]:
+    """The saved state, or None for a cold start; a broken file is moved aside, not fatal"""
+    try:
+        with open(path, "rb") as f:
+            state = json.loads(zlib.decompress(f.read()))
+    except FileNotFoundError:
+        return None
+    except (OSError, zlib.error, ValueError) as e:
+        set_aside(path, e)
+        return None
+    if not isinstance(state, dict) or state.get("format") != SNAPSHOT_FORMAT:
+        return None
+    return state
+
+
+def set_aside(path: str, reason: Exception) -> None:
+    """Keep an unusable snapshot for inspection under a name that is never loaded"""
+    bad = f"{path}.corrupt"
+    print(f"[Server] Ignoring unreadable snapshot {path} ({reason}), cold start")
+    try:
+        os.replace(path, bad)
+        print(f"[Server] Moved it to {bad}")
+    except OSError as e:
+        print(f"[Server] Could not move it aside: {e}")
+
+
+def restore(state: dict, registry: Any, chat: ChatStore, sessions: SessionStore) -> None:
+    """Warm start: reserve old ids, re-open sessions for resume, refill the chat"""
+    registry.reserve_ids(int(state.get("next_player_id", 0)))
+    for token, pid, player in state.get("sessions", []):
+        sessions.restore(token, int(pid), RESTORE_GRACE, player)
+    chat.load(state.get("chat", []), int(state.get("chat_next_id", 1)))
+
+
+async def run(path: str, interval: float, registry: Any, get_players, chat: ChatStore,
+              sessions: SessionStore) -> None:
+    """Write a snapshot every `interval` seconds, and a last one when cancelled"""
+    writing: asyncio.Future | None = None
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            state = capture(registry, get_players(), chat, sessions)
+            writing = asyncio.ensure_future(asyncio.to_thread(write, path, state))
+            # wait() neither raises nor cancels the write, which the final one below relies on
+            await asyncio.wait([writing])
+            _check_written(path, writing)
+            writing = None
+    except asyncio.CancelledError:
+        if writing is not None:
+            # Both writes go through the same temp file
+            await asyncio.wait([writing])
+            _check_written(path, writing)
+        try:
+            write(path, capture(registry, get_players(), chat, sessions))
+        except OSError as e:
+            print(f"[Server] Failed to write snapshot {path}: {e}")
+        raise
+
+
+def _check_written(path: str, writing: asyncio.Future) -> None:
+    # Disk full, a missing directory...: log it and try again next interval
+    e = writing.exception()
+    if isinstance(e, OSError):
+        print(f"[Server] Failed to write snapshot {path}: {e}")
+    elif e is not None:
+        raise e
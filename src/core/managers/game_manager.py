@@ -38,7 +38,7 @@ class GameManager:
         self.enemy_trainers = enemy_trainers
         self.bag = bag if bag is not None else Bag([], [])
 
-        self.mini_map = MiniMap(maps[start_map].path_name, scale=0.06)
+        self.mini_map = MiniMap(maps[start_map], scale=0.06)
         
         # Check If you should change scene
         self.should_change_scene = False
@@ -66,6 +66,7 @@ class GameManager:
             
     def try_switch_map(self) -> None:
         if self.should_change_scene:
+            self.maps[self.current_map_key].release_chunks()
             self.current_map_key = self.next_map
             self.next_map = ""
             self.should_change_scene = False
@@ -73,7 +74,7 @@ class GameManager:
                 self.player.position = self.maps[self.current_map_key].spawn
                 self.player.animation.update_pos(self.player.position)
             if self.mini_map:
-                self.mini_map.update(self.current_map.path_name)
+                self.mini_map.update(self.current_map)
             
             
     def check_collision(self, rect: pg.Rect) -> bool:
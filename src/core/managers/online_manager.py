@@ -1,12 +1,14 @@
 import asyncio
 import threading
 import time
-import queue
 import collections
 import json
 from collections import deque
+from urllib.parse import urlencode
 from typing import Optional
 from src.utils import Logger, GameSettings
+from server import wireCodec
+from server.chatStore import MAX_TEXT_LENGTH
 
 try:
     import websockets
@@ -16,9 +18,48 @@ except ImportError:
 
 from typing import Any
 
+# Remote players are drawn slightly in the past, interpolating between received positions.
+# The delay follows the server's frame interval (about two frames), within these bounds
+MIN_INTERPOLATION_DELAY = 0.05
+MAX_INTERPOLATION_DELAY = 0.25
+# How far past the newest position a player may be extrapolated while frames are late
+MAX_EXTRAPOLATION = 0.1
+# Positions kept per player, and a jump treated as a teleport instead of interpolated
+HISTORY_SIZE = 16
+TELEPORT_DISTANCE = 256.0
+
+
+class RemotePlayer:
+    """
+    Another player as last received, updated in place by the network thread.
+    `draw_x` / `draw_y` are the interpolated position for the current frame.
+    """
+    __slots__ = ("id", "x", "y", "map", "draw_x", "draw_y", "history")
+
+    def __init__(self, pid: int, x: float, y: float, map_name: str):
+        self.id = pid
+        self.x = x
+        self.y = y
+        self.map = map_name
+        self.draw_x = x
+        self.draw_y = y
+        # (server timestamp, x, y), oldest first
+        self.history = deque(maxlen=HISTORY_SIZE)
+
 
 class OnlineManager:
-    list_players: list[dict]
+    # Remote players as an immutable tuple, replaced only when someone joins or leaves
+    players: tuple[RemotePlayer, ...]
+    # Bumped whenever a remote player joins, leaves or moves
+    players_version: int
+    _remote_players: dict[int, RemotePlayer]
+    # Version for which every player already sits at its final position
+    _settled_version: int
+    # Server clock estimate (local time - server time) and frame timing
+    _clock_offset: Optional[float]
+    _frame_interval: float
+    _last_frame_ts: float
+    _prev_frame_ts: float
     player_id: int
     # WebSocket state
     _ws: Optional[Any]
@@ -26,10 +67,22 @@ class OnlineManager:
     _ws_thread: Optional[threading.Thread]
     _stop_event: threading.Event
     _lock: threading.Lock
-    _update_queue: queue.Queue
-    _chat_out_queue: queue.Queue
+    # Outgoing state, handed from the game thread to the sender (guarded by _lock):
+    # only the latest position is kept, chat lines are sent in order
+    _pending_update: Optional[dict]
+    _chat_out: collections.deque
+    # Set on the websocket loop when there is something to send
+    _send_wake: Optional[asyncio.Event]
+    _sender_notified: bool
     _chat_messages: collections.deque
     _last_chat_id: int
+    # Resume token from the server, presented on reconnect to keep our player id
+    _session_token: Optional[str]
+    # Wire format negotiated for the current connection
+    _codec: str
+    _maps_in: wireCodec.MapTable
+    _maps_out: wireCodec.MapTable
+    _maps_defined: set[int]
 
     def __init__(self):
         if websockets is None:
@@ -46,16 +99,27 @@ class OnlineManager:
             self.ws_url = f"ws://{self.base}"
 
         self.player_id = -1
-        self.list_players = []
+        self.players = ()
+        self.players_version = 0
+        self._remote_players = {}
+        self._settled_version = -1
+        self._clock_offset = None
+        self._frame_interval = MIN_INTERPOLATION_DELAY
+        self._last_frame_ts = 0.0
+        self._prev_frame_ts = 0.0
         self._ws = None
         self._ws_loop = None
         self._ws_thread = None
         self._stop_event = threading.Event()
         self._lock = threading.Lock()
-        self._update_queue = queue.Queue(maxsize=10)
-        self._chat_out_queue = queue.Queue(maxsize=50)
+        self._pending_update = None
+        self._chat_out = deque()
+        self._send_wake = None
+        self._sender_notified = False
         self._chat_messages = deque(maxlen=200)
         self._last_chat_id = 0
+        self._session_token = None
+        self._reset_codec()
 
         Logger.info("OnlineManager initialized")
 
@@ -65,26 +129,40 @@ class OnlineManager:
     def exit(self):
         self.stop()
 
-    def get_list_players(self) -> list[dict]:
-        """Get list of players"""
+    def get_players(self) -> tuple[RemotePlayer, ...]:
+        """
+        Remote players with draw_x / draw_y set for this frame. The tuple and records
+        are shared and reused, nothing is copied; check players_version to see changes.
+        """
         with self._lock:
-            return list(self.list_players)
-    
+            if self._clock_offset is None or self._settled_version == self.players_version:
+                return self.players
+            delay = min(max(self._frame_interval * 2, MIN_INTERPOLATION_DELAY), MAX_INTERPOLATION_DELAY)
+            render_ts = time.time() - self._clock_offset - delay
+            settled = True
+            for player in self.players:
+                if not self._interpolate(player, render_ts):
+                    settled = False
+            if settled:
+                # Nobody is between positions: skip the work until something new arrives
+                self._settled_version = self.players_version
+            return self.players
+
     def update(self, x: float, y: float, map_name: str) -> bool:
         """Queue position update (no dir / moving)."""
         if self.player_id == -1:
             return False
-        try:
+        with self._lock:
             # HINT: This part might be helpful for direction change
             # Maybe you can add other parameters?
-            self._update_queue.put_nowait({
+            # Replaces any position not sent yet, only the latest one matters
+            self._pending_update = {
                 "x": x,
                 "y": y,
                 "map": map_name,
-            })
-            return True
-        except queue.Full:
-            return False
+            }
+            self._notify_sender()
+        return True
 
     def start(self) -> None:
         if self._ws_thread and self._ws_thread.is_alive():
@@ -119,6 +197,36 @@ class OnlineManager:
             self._ws_loop.close()
             self._ws_loop = None
 
+    def _notify_sender(self) -> None:
+        """Wake the sender from the game thread (lock must be held)"""
+        loop = self._ws_loop
+        if loop is None or self._sender_notified:
+            return
+        self._sender_notified = True
+        try:
+            loop.call_soon_threadsafe(self._wake_sender)
+        except RuntimeError:
+            # Loop already closed
+            self._sender_notified = False
+
+    def _wake_sender(self) -> None:
+        if self._send_wake is not None:
+            self._send_wake.set()
+
+    def _connect_url(self) -> str:
+        """Server URL, with the resume token and last seen chat id after the first connection"""
+        if not self._session_token:
+            return self.ws_url
+        query = urlencode({"resume": self._session_token, "chat": self._last_chat_id})
+        return f"{self.ws_url.rstrip('/')}/?{query}"
+
+    def _reset_codec(self) -> None:
+        # Every connection starts on JSON with empty map tables
+        self._codec = wireCodec.CODEC_JSON
+        self._maps_in = wireCodec.MapTable()
+        self._maps_out = wireCodec.MapTable()
+        self._maps_defined = set()
+
     async def _close_ws(self) -> None:
         """Close WebSocket connection"""
         if self._ws:
@@ -137,14 +245,26 @@ class OnlineManager:
             try:
                 # Connect to WebSocket server
                 async with websockets.connect(
-                    self.ws_url,
+                    self._connect_url(),
                     ping_interval=20,
-                    ping_timeout=10
+                    ping_timeout=10,
+                    compression="deflate" if GameSettings.ONLINE_COMPRESSION else None
                 ) as websocket:
                     self._ws = websocket
                     Logger.info("WebSocket connected")
                     reconnect_delay = 1.0  # Reset delay on successful connection
 
+                    self._reset_codec()
+                    if GameSettings.ONLINE_BINARY_PROTOCOL or GameSettings.ONLINE_BATCH_FRAMES:
+                        codecs = [wireCodec.CODEC_JSON]
+                        if GameSettings.ONLINE_BINARY_PROTOCOL:
+                            codecs.insert(0, wireCodec.CODEC_BINARY)
+                        await websocket.send(json.dumps({
+                            "type": "hello",
+                            "codecs": codecs,
+                            "batch": GameSettings.ONLINE_BATCH_FRAMES
+                        }))
+
                     # Start sender task
                     sender_task = asyncio.create_task(self._ws_sender(websocket))
 
@@ -172,33 +292,68 @@ class OnlineManager:
                 if not self._stop_event.is_set():
                     await asyncio.sleep(0.5)
 
-    async def _handle_message(self, message: str) -> None:
+    async def _handle_message(self, message: str | bytes) -> None:
         """Handle incoming WebSocket message"""
         try:
-            data = json.loads(message)
+            if isinstance(message, bytes):
+                data = wireCodec.decode(message, self._maps_in)
+                if data is None:
+                    return
+            else:
+                data = json.loads(message)
+            if data.get("type") == "batch":
+                # Everything the server had for us this tick, in order
+                for part in data.get("messages", []):
+                    self._handle_data(part)
+            else:
+                self._handle_data(data)
+
+        except json.JSONDecodeError as e:
+            Logger.warning(f"Failed to parse WebSocket message: {e}")
+        except Exception as e:
+            Logger.warning(f"Error handling WebSocket message: {e}")
+
+    def _handle_data(self, data: dict) -> None:
+        """Handle one decoded server message"""
+        try:
             msg_type = data.get("type")
 
-            if msg_type == "registered":
+            if msg_type == "codec":
+                self._codec = str(data.get("codec", wireCodec.CODEC_JSON))
+                Logger.info(f"OnlineManager using {self._codec} protocol")
+
+            elif msg_type == "registered":
                 self.player_id = int(data.get("id", -1))
+                self._session_token = data.get("token")
                 Logger.info(f"OnlineManager registered with id={self.player_id}")
 
             elif msg_type == "players_update":
+                # Full snapshot (keyframe): replace everything we know
+                players_data = data.get("players", {})
+                with self._lock:
+                    self._on_frame(float(data.get("timestamp", time.time())))
+                    self._apply_players(players_data)
+                    gone = [pid for pid in self._remote_players
+                            if pid not in players_data and str(pid) not in players_data]
+                    for pid in gone:
+                        del self._remote_players[pid]
+                    if gone:
+                        # _apply_players skips empty keyframes, so the bump can't be left to it
+                        self.players = tuple(self._remote_players.values())
+                        self.players_version += 1
+
+            elif msg_type == "players_delta":
+                # Patch: only players who joined / changed / left since last tick
                 players_data = data.get("players", {})
+                removed = data.get("removed", [])
                 with self._lock:
-                    filtered = []
-                    for pid_str, player_data in players_data.items():
-                        pid = int(pid_str)
-                        if pid != self.player_id:
-
-                            # HINT: This part might be helpful for direction change
-                            # Maybe you can add other parameters?
-                            filtered.append({
-                                "id": pid,
-                                "x": float(player_data.get("x", 0)),
-                                "y": float(player_data.get("y", 0)),
-                                "map": str(player_data.get("map", "")),
-                            })
-                    self.list_players = filtered
+                    self._on_frame(float(data.get("timestamp", time.time())))
+                    if removed:
+                        for pid in removed:
+                            self._remote_players.pop(int(pid), None)
+                        self.players = tuple(self._remote_players.values())
+                        self.players_version += 1
+                    self._apply_players(players_data)
 
             elif msg_type == "chat_update":
                 messages = data.get("messages", [])
@@ -212,56 +367,177 @@ class OnlineManager:
             elif msg_type == "error":
                 Logger.warning(f"Server error: {data.get('message', 'unknown')}")
 
-        except json.JSONDecodeError as e:
-            Logger.warning(f"Failed to parse WebSocket message: {e}")
         except Exception as e:
             Logger.warning(f"Error handling WebSocket message: {e}")
 
+    def _apply_players(self, players_data: dict) -> None:
+        """Merge server player records into the remote player table in place (lock must be held)"""
+        if not players_data:
+            return
+        joined = False
+        for pid, player_data in players_data.items():
+            # JSON object keys are strings, the binary codec gives ints
+            pid = int(pid)
+            if pid != self.player_id:
+
+                # HINT: This part might be helpful for direction change
+                # Maybe you can add other parameters?
+                x = float(player_data.get("x", 0))
+                y = float(player_data.get("y", 0))
+                map_name = player_data.get("map", "")
+                player = self._remote_players.get(pid)
+                if player is None:
+                    player = self._remote_players[pid] = RemotePlayer(pid, x, y, map_name)
+                    joined = True
+                self._record_position(player, x, y, map_name)
+        if joined:
+            self.players = tuple(self._remote_players.values())
+        self.players_version += 1
+
+    def _on_frame(self, timestamp: float) -> None:
+        """Track the server clock and frame rate from a players frame (lock must be held)"""
+        offset = time.time() - timestamp
+        # Least delayed frame wins, with a slow drift back up in case the clocks move apart
+        if self._clock_offset is None or offset < self._clock_offset:
+            self._clock_offset = offset
+        else:
+            self._clock_offset += (offset - self._clock_offset) * 0.01
+        if self._last_frame_ts:
+            gap = min(timestamp - self._last_frame_ts, MAX_INTERPOLATION_DELAY)
+            if gap > 0:
+                self._frame_interval += (gap - self._frame_interval) * 0.1
+        self._prev_frame_ts = self._last_frame_ts
+        self._last_frame_ts = timestamp
+
+    def _record_position(self, player: RemotePlayer, x: float, y: float, map_name: str) -> None:
+        """Append a received position to the player's history (lock must be held)"""
+        history = player.history
+        if (not history or player.map != map_name
+                or abs(player.x - x) + abs(player.y - y) > TELEPORT_DISTANCE):
+            # New, changed map or teleported: start over instead of sliding across
+            history.clear()
+            player.draw_x = x
+            player.draw_y = y
+        elif history[-1][0] < self._prev_frame_ts:
+            # Not in the frames since its last position: it stood still until the previous one
+            history.append((self._prev_frame_ts, history[-1][1], history[-1][2]))
+        history.append((self._last_frame_ts, x, y))
+        player.x = x
+        player.y = y
+        player.map = map_name
+
+    def _interpolate(self, player: RemotePlayer, render_ts: float) -> bool:
+        """
+        Set the player's draw position for server time `render_ts` (lock must be held).
+        Returns True if it is at its newest position and will stay there.
+        """
+        history = player.history
+        if not history:
+            return True
+        first = history[0]
+        if render_ts <= first[0]:
+            player.draw_x, player.draw_y = first[1], first[2]
+            return len(history) == 1
+        last = history[-1]
+        if render_ts >= last[0]:
+            if len(history) < 2 or last[0] < self._last_frame_ts:
+                # Missing from the newest frames means it has not moved since
+                player.draw_x, player.draw_y = last[1], last[2]
+                return True
+            # Newer frames are late: keep going the same way for a little while, then
+            # ease back, since the player may simply have stopped (no frame says so)
+            prev = history[-2]
+            span = last[0] - prev[0]
+            ahead = render_ts - last[0]
+            if span <= 0 or ahead >= 2 * MAX_EXTRAPOLATION:
+                player.draw_x, player.draw_y = last[1], last[2]
+                return True
+            k = min(ahead, 2 * MAX_EXTRAPOLATION - ahead) / span
+            player.draw_x = last[1] + (last[1] - prev[1]) * k
+            player.draw_y = last[2] + (last[2] - prev[2]) * k
+            return False
+        for i in range(len(history) - 1, 0, -1):
+            a = history[i - 1]
+            if a[0] <= render_ts:
+                b = history[i]
+                t = (render_ts - a[0]) / (b[0] - a[0]) if b[0] > a[0] else 1.0
+                player.draw_x = a[1] + (b[1] - a[1]) * t
+                player.draw_y = a[2] + (b[2] - a[2]) * t
+                return False
+        return False
+
     async def _ws_sender(self, websocket: Any) -> None:
-        """Send updates to server via WebSocket"""
+        """Send updates to server via WebSocket, woken by the game thread instead of polling"""
         update_interval = 0.0167  # 60 updates per second
-        last_update = time.monotonic()
+        last_update = 0.0
+        loop = asyncio.get_running_loop()
+        timer: Optional[asyncio.TimerHandle] = None
+        self._send_wake = asyncio.Event()
+        # Something may have been queued while disconnected
+        self._send_wake.set()
 
-        while not self._stop_event.is_set():
-            try:
-                # Send position updates
-                now = time.monotonic()
-                if now - last_update >= update_interval:
-                    # Collapse queue to latest entry to avoid sending stale movement
+        try:
+            while not self._stop_event.is_set():
+                await self._send_wake.wait()
+                self._send_wake.clear()
+                try:
+                    now = time.monotonic()
                     latest_update = None
-                    try:
-                        while True:
-                            latest_update = self._update_queue.get_nowait()
-                    except queue.Empty:
-                        pass
-
+                    with self._lock:
+                        self._sender_notified = False
+                        chat_texts = list(self._chat_out)
+                        self._chat_out.clear()
+                        # Positions are rate limited; a newer one may replace this one meanwhile
+                        if self._pending_update is not None and now - last_update >= update_interval:
+                            latest_update = self._pending_update
+                            self._pending_update = None
+                        wait = update_interval - (now - last_update) if self._pending_update is not None else 0.0
+
+                    # Send chat messages right away
+                    if self.player_id >= 0:
+                        for chat_text in chat_texts:
+                            message = {
+                                "type": "chat_send",
+                                "text": chat_text
+                            }
+                            await websocket.send(json.dumps(message))
+
+                    # Send position updates
                     if latest_update and self.player_id >= 0:
-                        message = {
-                            "type": "player_update",
-                            "x": latest_update.get("x"),
-                            "y": latest_update.get("y"),
-                            "map": latest_update.get("map"),
-                        }
-                        await websocket.send(json.dumps(message))
+                        if self._codec == wireCodec.CODEC_BINARY:
+                            await self._send_binary_position(websocket, latest_update)
+                        else:
+                            message = {
+                                "type": "player_update",
+                                "x": latest_update.get("x"),
+                                "y": latest_update.get("y"),
+                                "map": latest_update.get("map"),
+                            }
+                            await websocket.send(json.dumps(message))
                         last_update = now
 
-                # Send chat messages
-                try:
-                    chat_text = self._chat_out_queue.get_nowait()
-                    if self.player_id >= 0:
-                        message = {
-                            "type": "chat_send",
-                            "text": chat_text
-                        }
-                        await websocket.send(json.dumps(message))
-                except queue.Empty:
-                    pass
+                    if wait > 0 and (timer is None or timer.when() <= loop.time()):
+                        # Come back for the held position once the interval has passed
+                        timer = loop.call_later(wait, self._send_wake.set)
 
-                await asyncio.sleep(0.01)  # Small sleep to prevent busy waiting
-
-            except Exception as e:
-                Logger.warning(f"WebSocket send error: {e}")
-                await asyncio.sleep(0.1)
+                except Exception as e:
+                    Logger.warning(f"WebSocket send error: {e}")
+                    await asyncio.sleep(0.1)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            self._send_wake = None
+
+    async def _send_binary_position(self, websocket: Any, update: dict) -> None:
+        """Binary player_update, preceded by the map definition the first time a map is used"""
+        map_name = str(update.get("map", ""))
+        map_id = self._maps_out.id_for(map_name)
+        if map_id not in self._maps_defined:
+            self._maps_defined.add(map_id)
+            await websocket.send(wireCodec.encode_map_define(map_id, map_name))
+        await websocket.send(wireCodec.encode_player_update(
+            float(update.get("x", 0)), float(update.get("y", 0)), map_id
+        ))
 
     # -----------------------------
     # Chat API
@@ -269,14 +545,16 @@ class OnlineManager:
     def send_chat(self, text: str) -> bool:
         if self.player_id == -1:
             return False
-        t = (text or "").strip()
+        # The server keeps MAX_TEXT_LENGTH characters anyway, and closes on oversized frames
+        t = (text or "").strip()[:MAX_TEXT_LENGTH]
         if not t:
             return False
-        try:
-            self._chat_out_queue.put_nowait(t)
-            return True
-        except queue.Full:
-            return False
+        with self._lock:
+            if len(self._chat_out) >= 50:
+                return False
+            self._chat_out.append(t)
+            self._notify_sender()
+        return True
 
     def get_recent_chat(self, limit: int = 50) -> list[dict]:
         with self._lock:
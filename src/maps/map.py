@@ -1,40 +1,138 @@
+import os
+
 import pygame as pg
 import pytmx
 
 from src.utils import load_tmx, Position, GameSettings, PositionCamera, Teleport
+from src.maps import map_cache
+
+# The map is baked in square chunks of CHUNK_TILES tiles when they first come into view
+CHUNK_TILES = 8
+# Baked chunks kept per map (512px chunks: a 1280x720 view needs at most 12)
+MAX_CHUNKS = 24
+
+class TileImages:
+    """
+    Tile images of one map scaled to TILE_SIZE.
+    The scaled surfaces are shared by every map that uses the same tileset.
+    """
+    # (tileset, tile id in the tileset, flip flags, size) -> scaled image, whether it is fully opaque
+    _shared: dict[tuple, tuple[pg.Surface | None, bool]] = {}
+
+    def __init__(self, tmxdata: pytmx.TiledMap):
+        self.tmxdata = tmxdata
+        self._by_gid: dict[int, tuple[pg.Surface | None, bool]] = {}
+        # pytmx gid -> (gid in the .tmx, flip flags)
+        self._tiled = {gid: (tiled_gid, flags) for tiled_gid, entries in tmxdata.gidmap.items() for gid, flags in entries}
+
+    def get(self, gid: int) -> pg.Surface | None:
+        return self.lookup(gid)[0]
+
+    def lookup(self, gid: int) -> tuple[pg.Surface | None, bool]:
+        try:
+            return self._by_gid[gid]
+        except KeyError:
+            pass
+        key = self._shared_key(gid)
+        if key not in self._shared:
+            image = self.tmxdata.get_tile_image_by_gid(gid)
+            opaque = False
+            if image is not None:
+                image = pg.transform.scale(image, (GameSettings.TILE_SIZE, GameSettings.TILE_SIZE))
+                opaque = pg.mask.from_surface(image, 254).count() == GameSettings.TILE_SIZE ** 2
+            self._shared[key] = (image, opaque)
+        self._by_gid[gid] = self._shared[key]
+        return self._by_gid[gid]
+
+    def _shared_key(self, gid: int) -> tuple:
+        tiled_gid, flags = self._tiled.get(gid, (gid, None))
+        try:
+            tileset = self.tmxdata.get_tileset_from_gid(gid)
+        except ValueError:
+            # Not from a tileset; only this map knows the image
+            return (self.tmxdata.filename, gid, None, GameSettings.TILE_SIZE)
+        source = tileset.source or tileset.name
+        if self.tmxdata.filename:
+            source = os.path.normpath(os.path.join(os.path.dirname(self.tmxdata.filename), source))
+        return (source, tiled_gid - tileset.firstgid, flags, GameSettings.TILE_SIZE)
 
 class Map:
     # Map Properties
     path_name: str
-    tmxdata: pytmx.TiledMap
+    width: int
+    height: int
     # Position Argument
     spawn: Position
     teleporters: list[Teleport]
     # Rendering Properties
-    _surface: pg.Surface
+    _chunks: dict[tuple[int, int], pg.Surface | None]
+    _minimaps: dict[float, pg.Surface]
+    _baked: map_cache.BakedMap | None
+    _tmxdata: pytmx.TiledMap | None
     _collision_map: list[pg.Rect]
+    # One byte per tile, 1 = blocked / bush, indexed by y * width + x
+    _collision_grid: bytearray
+    _bush_grid: bytearray
 
     def __init__(self, path: str, tp: list[Teleport], spawn: Position):
         self.path_name = path
-        self.tmxdata = load_tmx(path)
         self.spawn = spawn
         self.teleporters = tp
+        self._tmxdata = None
+        self._tiles = None
 
-        pixel_w = self.tmxdata.width * GameSettings.TILE_SIZE
-        pixel_h = self.tmxdata.height * GameSettings.TILE_SIZE
+        # A baked copy from an earlier launch lets us skip the .tmx entirely
+        cache_file = map_cache.cache_file(path, GameSettings.TILE_SIZE, CHUNK_TILES)
+        self._baked = map_cache.load(cache_file) if cache_file else None
+        if self._baked is not None:
+            self.width, self.height = self._baked.width, self._baked.height
+            self._collision_grid = self._baked.collision_grid
+            self._bush_grid = self._baked.bush_grid
+            self._collision_map = self._grid_rects(self._collision_grid)
+            self._bush_map = self._grid_rects(self._bush_grid)
+        else:
+            self.width, self.height = self.tmxdata.width, self.tmxdata.height
+            # Prebake the collision map
+            self._collision_map = self._create_collision_map()
+            self._bush_map = self._create_bush_map()
+            self._collision_grid = self._create_tile_grid(self._collision_map)
+            self._bush_grid = self._create_tile_grid(self._bush_map)
 
-        # Prebake the map
-        self._surface = pg.Surface((pixel_w, pixel_h), pg.SRCALPHA)
-        self._render_all_layers(self._surface)
-        # Prebake the collision map
-        self._collision_map = self._create_collision_map()
-        self._bush_map = self._create_bush_map()
+        # Map chunks, baked lazily by draw(); None marks an empty chunk
+        self._chunks = {}
+        self._minimaps = {}
+        self._chunks_w = -(-self.width // CHUNK_TILES)
+        self._chunks_h = -(-self.height // CHUNK_TILES)
+        if self._baked is None and cache_file is not None:
+            self._write_cache(cache_file)
+
+    @property
+    def tmxdata(self) -> pytmx.TiledMap:
+        # Only parsed when the map isn't in the bake cache
+        if self._tmxdata is None:
+            self._tmxdata = load_tmx(self.path_name)
+        return self._tmxdata
 
     def update(self, dt: float):
         return
 
     def draw(self, screen: pg.Surface, camera: PositionCamera):
-        screen.blit(self._surface, camera.transform_position(Position(0, 0)))
+        # Only the chunks under the camera are blitted
+        chunk_px = CHUNK_TILES * GameSettings.TILE_SIZE
+        view_w, view_h = screen.get_size()
+        cam_x, cam_y = int(camera.x), int(camera.y)
+        first_cx = max(cam_x // chunk_px, 0)
+        first_cy = max(cam_y // chunk_px, 0)
+        last_cx = min((cam_x + view_w - 1) // chunk_px, self._chunks_w - 1)
+        last_cy = min((cam_y + view_h - 1) // chunk_px, self._chunks_h - 1)
+        for cy in range(first_cy, last_cy + 1):
+            for cx in range(first_cx, last_cx + 1):
+                chunk = self._get_chunk(cx, cy)
+                if chunk is not None:
+                    screen.blit(chunk, (cx * chunk_px - cam_x, cy * chunk_px - cam_y))
+
+        visible = (last_cx - first_cx + 1) * (last_cy - first_cy + 1)
+        self._evict_chunks(cam_x + view_w // 2, cam_y + view_h // 2, max(MAX_CHUNKS, visible))
         
         # Draw the hitboxes collision map
         if GameSettings.DRAW_HITBOXES:
@@ -45,14 +143,25 @@ class Map:
         
         
     def check_collision(self, rect: pg.Rect) -> bool:
-        for collision_rect in self._collision_map:
-            if rect.colliderect(collision_rect):
-                return True
-        return False
+        return self._check_grid(self._collision_grid, rect)
     
     def check_bush_collision(self, rect: pg.Rect) -> bool:
-        for bush in self._bush_map:
-            if rect.colliderect(bush):
+        return self._check_grid(self._bush_grid, rect)
+
+    def _check_grid(self, grid: bytearray, rect: pg.Rect) -> bool:
+        # Only the tiles the rect overlaps are looked at
+        if rect.width <= 0 or rect.height <= 0:
+            return False
+        size = GameSettings.TILE_SIZE
+        width = self.width
+        x0 = max(rect.left // size, 0)
+        x1 = min((rect.right - 1) // size, width - 1)
+        y0 = max(rect.top // size, 0)
+        y1 = min((rect.bottom - 1) // size, self.height - 1)
+        if x0 > x1:
+            return False
+        for y in range(y0, y1 + 1):
+            if any(grid[y * width + x0:y * width + x1 + 1]):
                 return True
         return False
 
@@ -67,23 +176,108 @@ class Map:
                 return tp
         return None
 
-    def _render_all_layers(self, target: pg.Surface) -> None:
-        for layer in self.tmxdata.visible_layers:
-            if isinstance(layer, pytmx.TiledTileLayer):
-                self._render_tile_layer(target, layer)
-            # elif isinstance(layer, pytmx.TiledImageLayer) and layer.image:
-            #     target.blit(layer.image, (layer.x or 0, layer.y or 0))
- 
-    def _render_tile_layer(self, target: pg.Surface, layer: pytmx.TiledTileLayer) -> None:
-        for x, y, gid in layer:
-            if gid == 0:
-                continue
-            image = self.tmxdata.get_tile_image_by_gid(gid)
-            if image is None:
-                continue
+    def minimap_surface(self, scale: float) -> pg.Surface:
+        """The whole map shrunk by `scale`, built from the chunks the first time it's asked for"""
+        surface = self._minimaps.get(scale)
+        if surface is None:
+            surface = self._minimaps[scale] = self._render_minimap(scale)
+        return surface
+
+    def release_chunks(self) -> None:
+        """Drop every baked chunk, e.g. when the player leaves this map"""
+        self._chunks.clear()
+
+    def _get_chunk(self, cx: int, cy: int) -> pg.Surface | None:
+        key = (cx, cy)
+        if key not in self._chunks:
+            self._chunks[key] = self._bake_chunk(cx, cy)
+        return self._chunks[key]
+
+    def _evict_chunks(self, center_x: int, center_y: int, limit: int) -> None:
+        # Forget the chunks farthest from the view centre
+        if len(self._chunks) <= limit:
+            return
+        chunk_px = CHUNK_TILES * GameSettings.TILE_SIZE
+
+        def distance(key: tuple[int, int]) -> int:
+            dx = (key[0] + 0.5) * chunk_px - center_x
+            dy = (key[1] + 0.5) * chunk_px - center_y
+            return dx * dx + dy * dy
+
+        for key in sorted(self._chunks, key=distance, reverse=True)[:len(self._chunks) - limit]:
+            del self._chunks[key]
+
+    def _bake_chunk(self, cx: int, cy: int) -> pg.Surface | None:
+        if self._baked is not None:
+            return self._baked.chunk(cx, cy)
+        target, opaque = self._render_chunk(cx, cy)
+        # Chunks without see-through pixels blit much faster without alpha
+        if target is not None and opaque:
+            return target.convert()
+        return target
 
-            image = pg.transform.scale(image, (GameSettings.TILE_SIZE, GameSettings.TILE_SIZE))
-            target.blit(image, (x * GameSettings.TILE_SIZE, y * GameSettings.TILE_SIZE))
+    def _render_minimap(self, scale: float) -> pg.Surface:
+        chunk_px = CHUNK_TILES * GameSettings.TILE_SIZE
+        target = pg.Surface((int(self.width * GameSettings.TILE_SIZE * scale),
+                             int(self.height * GameSettings.TILE_SIZE * scale)), pg.SRCALPHA)
+        for cy in range(self._chunks_h):
+            for cx in range(self._chunks_w):
+                # Chunks drawn right now are reused, the rest are baked without being kept
+                chunk = self._chunks[(cx, cy)] if (cx, cy) in self._chunks else self._bake_chunk(cx, cy)
+                if chunk is None:
+                    continue
+                # Edges are rounded the same way for neighbours, so there are no seams
+                x0, y0 = int(cx * chunk_px * scale), int(cy * chunk_px * scale)
+                x1 = int((cx * chunk_px + chunk.get_width()) * scale)
+                y1 = int((cy * chunk_px + chunk.get_height()) * scale)
+                if x1 > x0 and y1 > y0:
+                    target.blit(pg.transform.scale(chunk, (x1 - x0, y1 - y0)), (x0, y0))
+        return target
+
+    def _render_chunk(self, cx: int, cy: int) -> tuple[pg.Surface | None, bool]:
+        if self._tiles is None:
+            self._tiles = TileImages(self.tmxdata)
+            self._tile_layers = [layer for layer in self.tmxdata.visible_layers if isinstance(layer, pytmx.TiledTileLayer)]
+        x0, y0 = cx * CHUNK_TILES, cy * CHUNK_TILES
+        x1 = min(x0 + CHUNK_TILES, self.width)
+        y1 = min(y0 + CHUNK_TILES, self.height)
+        target = pg.Surface(((x1 - x0) * GameSettings.TILE_SIZE, (y1 - y0) * GameSettings.TILE_SIZE), pg.SRCALPHA)
+        # Cells that got an opaque tile on some layer
+        covered: set[tuple[int, int]] = set()
+        drawn = False
+        for layer in self._tile_layers:
+            drawn |= self._render_tile_layer(target, layer, x0, y0, x1, y1, covered)
+        if not drawn:
+            return None, False
+        return target, len(covered) == (x1 - x0) * (y1 - y0)
+
+    def _write_cache(self, file) -> None:
+        # Render every chunk once so the next launch can read them back
+        chunks = (
+            (cx, cy, *self._render_chunk(cx, cy))
+            for cy in range(self._chunks_h) for cx in range(self._chunks_w)
+        )
+        if map_cache.write(file, self.width, self.height, self._collision_grid, self._bush_grid, chunks):
+            self._baked = map_cache.load(file)
+
+    def _render_tile_layer(self, target: pg.Surface, layer: pytmx.TiledTileLayer,
+                           x0: int, y0: int, x1: int, y1: int, covered: set[tuple[int, int]]) -> bool:
+        drawn = False
+        for y in range(y0, y1):
+            row = layer.data[y]
+            for x in range(x0, x1):
+                gid = row[x]
+                if gid == 0:
+                    continue
+                image, opaque = self._tiles.lookup(gid)
+                if image is None:
+                    continue
+
+                target.blit(image, ((x - x0) * GameSettings.TILE_SIZE, (y - y0) * GameSettings.TILE_SIZE))
+                drawn = True
+                if opaque:
+                    covered.add((x, y))
+        return drawn
     
     def _create_collision_map(self) -> list[pg.Rect]:
         rects = []
@@ -94,6 +288,16 @@ class Map:
                         rects.append(pg.Rect(x * GameSettings.TILE_SIZE, y * GameSettings.TILE_SIZE, GameSettings.TILE_SIZE, GameSettings.TILE_SIZE))
         return rects
 
+    def _create_tile_grid(self, rects: list[pg.Rect]) -> bytearray:
+        grid = bytearray(self.width * self.height)
+        for rect in rects:
+            grid[rect.y // GameSettings.TILE_SIZE * self.width + rect.x // GameSettings.TILE_SIZE] = 1
+        return grid
+
+    def _grid_rects(self, grid: bytearray) -> list[pg.Rect]:
+        size = GameSettings.TILE_SIZE
+        return [pg.Rect(i % self.width * size, i // self.width * size, size, size) for i, cell in enumerate(grid) if cell]
+
     def _create_bush_map(self) -> list[pg.Rect]:
         rects = []
         for layer in self.tmxdata.visible_layers:
@@ -123,41 +327,16 @@ class MiniMap:
     
     # Map Properties
     path_name: str
-    tmxdata: pytmx.TiledMap
     _surface: pg.Surface
 
-    def __init__(self, path: str, scale: float):
-        
-        self.path_name = path
-        self.tmxdata = load_tmx(path)
+    def __init__(self, game_map: Map, scale: float):
         self.scale = scale
+        self.update(game_map)
 
-        # 完整地圖像素大小（原圖）
-        pixel_w = self.tmxdata.width * GameSettings.TILE_SIZE
-        pixel_h = self.tmxdata.height * GameSettings.TILE_SIZE
-
-        full_surface = pg.Surface((pixel_w, pixel_h), pg.SRCALPHA)
-        self._render_all_layers(full_surface)
-
-        scaled_w = int(pixel_w * self.scale)
-        scaled_h = int(pixel_h * self.scale)
-        self._surface = pg.transform.scale(full_surface, (scaled_w, scaled_h))
-
-    def update(self, path: str):
- 
-        self.path_name = path
-        self.tmxdata = load_tmx(path)
-
-        pixel_w = self.tmxdata.width * GameSettings.TILE_SIZE
-        pixel_h = self.tmxdata.height * GameSettings.TILE_SIZE
-
-        full_surface = pg.Surface((pixel_w, pixel_h), pg.SRCALPHA)
-        self._render_all_layers(full_surface)
-
-        scaled_w = int(pixel_w * self.scale)
-        scaled_h = int(pixel_h * self.scale)
-        self._surface = pg.transform.scale(full_surface, (scaled_w, scaled_h))
-
+    def update(self, game_map: Map):
+        # Each Map keeps its own shrunk copy, so switching maps doesn't rebuild it
+        self.path_name = game_map.path_name
+        self._surface = game_map.minimap_surface(self.scale)
 
     def draw(self, screen: pg.Surface, player_pos: Position):
 
@@ -172,20 +351,3 @@ class MiniMap:
         py = y + py
 
         pg.draw.circle(screen, (255, 50, 50), (px, py), 3)
-
-    def _render_all_layers(self, target: pg.Surface) -> None:
-        for layer in self.tmxdata.visible_layers:
-            if isinstance(layer, pytmx.TiledTileLayer):
-                self._render_tile_layer(target, layer)
-            
- 
-    def _render_tile_layer(self, target: pg.Surface, layer: pytmx.TiledTileLayer) -> None:
-        for x, y, gid in layer:
-            if gid == 0:
-                continue
-            image = self.tmxdata.get_tile_image_by_gid(gid)
-            if image is None:
-                continue
-
-            image = pg.transform.scale(image, (GameSettings.TILE_SIZE, GameSettings.TILE_SIZE))
-            target.blit(image, (x * GameSettings.TILE_SIZE, y * GameSettings.TILE_SIZE))
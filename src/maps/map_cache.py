@@ -0,0 +1,160 @@
+"""
+On-disk cache of baked maps, so later launches skip pytmx.
+
+One file per map under CACHE_DIR, named after the map and a hash of the .tmx, every
+tileset and image it uses, TILE_SIZE and the chunk size. Any change to those gives a new
+name, so a stale file is never read; it is deleted when the new one is written.
+
+File layout:
+
+    MAGIC, <I header length, JSON header (size, chunk table)
+    collision grid, bush grid     one byte per tile
+    chunk pixels                  raw RGB (opaque) or RGBA, one block per non-empty chunk
+
+The file is memory-mapped and chunks are turned into surfaces only when drawn.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import xml.etree.ElementTree as ElementTree
+from pathlib import Path
+from typing import Iterable
+
+import pygame as pg
+
+from src.utils import Logger
+from src.utils.loader import ASSETS_DIR
+
+CACHE_DIR = Path("saves") / "map_cache"
+CACHE_FORMAT = 1
+_MAGIC = b"MGBAKE"
+_HEADER_LENGTH = struct.Struct("<I")
+
+
+class BakedMap:
+    """A map read back from the cache"""
+    width: int
+    height: int
+    collision_grid: bytearray
+    bush_grid: bytearray
+
+    def __init__(self, data: mmap.mmap, header: dict, body: int):
+        self._data = data
+        self.width = header["width"]
+        self.height = header["height"]
+        tiles = self.width * self.height
+        self.collision_grid = bytearray(data[body:body + tiles])
+        self.bush_grid = bytearray(data[body + tiles:body + 2 * tiles])
+        # (cx, cy) -> (offset, width, height, opaque)
+        self._chunks = {(cx, cy): (body + offset, w, h, opaque) for cx, cy, offset, w, h, opaque in header["chunks"]}
+
+    def check(self, size: int) -> None:
+        """Raise ValueError unless the grids and every chunk fit in a file of `size` bytes"""
+        tiles = self.width * self.height
+        if len(self.collision_grid) != tiles or len(self.bush_grid) != tiles:
+            raise ValueError("truncated grids")
+        for offset, w, h, opaque in self._chunks.values():
+            if offset < 0 or w <= 0 or h <= 0 or offset + w * h * (3 if opaque else 4) > size:
+                raise ValueError("truncated chunk data")
+
+    def chunk(self, cx: int, cy: int) -> pg.Surface | None:
+        entry = self._chunks.get((cx, cy))
+        if entry is None:
+            return None
+        offset, w, h, opaque = entry
+        if opaque:
+            # Chunks without see-through pixels blit much faster without alpha
+            return pg.image.frombuffer(self._data[offset:offset + w * h * 3], (w, h), "RGB").convert()
+        return pg.image.frombuffer(self._data[offset:offset + w * h * 4], (w, h), "RGBA").convert_alpha()
+
+
+def cache_file(path: str, tile_size: int, chunk_tiles: int) -> Path | None:
+    """Where the baked form of the map would be, or None if its files can't be read"""
+    digest = hashlib.sha1(f"{CACHE_FORMAT}:{tile_size}:{chunk_tiles}".encode())
+    try:
+        for source in _map_sources(ASSETS_DIR / "maps" / path):
+            digest.update(source.read_bytes())
+    except (OSError, ElementTree.ParseError) as e:
+        Logger.warning(f"Map cache disabled for {path}: {e}")
+        return None
+    return CACHE_DIR / f"{_stem(path)}-{digest.hexdigest()[:16]}.bake"
+
+
+def load(file: Path) -> BakedMap | None:
+    if not file.exists():
+        return None
+    try:
+        with open(file, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(_MAGIC)] != _MAGIC:
+            raise ValueError("not a baked map")
+        start = len(_MAGIC) + _HEADER_LENGTH.size
+        (length,) = _HEADER_LENGTH.unpack_from(data, len(_MAGIC))
+        header = json.loads(data[start:start + length])
+        baked = BakedMap(data, header, start + length)
+        baked.check(len(data))
+        return baked
+    except (OSError, ValueError, KeyError, TypeError, struct.error) as e:
+        Logger.warning(f"Ignoring broken map cache {file}: {e}")
+        return None
+
+
+def write(file: Path, width: int, height: int, collision_grid: bytearray, bush_grid: bytearray,
+          chunks: Iterable[tuple[int, int, pg.Surface | None, bool]]) -> bool:
+    """Write a baked map; chunks are (cx, cy, surface or None when empty, opaque)"""
+    table = []
+    pixels = [bytes(collision_grid), bytes(bush_grid)]
+    offset = len(pixels[0]) + len(pixels[1])
+    for cx, cy, surface, opaque in chunks:
+        if surface is None:
+            continue
+        data = pg.image.tobytes(surface, "RGB" if opaque else "RGBA")
+        table.append((cx, cy, offset, surface.get_width(), surface.get_height(), opaque))
+        pixels.append(data)
+        offset += len(data)
+    header = json.dumps({"format": CACHE_FORMAT, "width": width, "height": height, "chunks": table}).encode()
+
+    # Per process, so games launched at the same time don't write into each other's file
+    tmp = file.with_name(f"{file.name}.{os.getpid()}.tmp")
+    try:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(_MAGIC + _HEADER_LENGTH.pack(len(header)) + header)
+            for data in pixels:
+                f.write(data)
+        os.replace(tmp, file)
+    except OSError as e:
+        Logger.warning(f"Failed to write map cache {file}: {e}")
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        return False
+    # Older bakes of the same map can't be used again
+    for old in file.parent.glob(f"{file.name.rsplit('-', 1)[0]}-*.bake"):
+        if old != file:
+            try:
+                old.unlink()
+            except OSError:
+                pass
+    return True
+
+
+def _stem(path: str) -> str:
+    return path.replace("/", "_").replace("\\", "_").rsplit(".", 1)[0]
+
+
+def _map_sources(tmx: Path) -> list[Path]:
+    """The .tmx and every tileset and image file it pulls in"""
+    sources = [tmx]
+    for file in sources:
+        if file.suffix not in (".tmx", ".tsx"):
+            continue
+        root = ElementTree.parse(file).getroot()
+        for element in [*root.iter("tileset"), *root.iter("image")]:
+            source = element.get("source")
+            if source:
+                sources.append((file.parent / source).resolve())
+    return sources
@@ -75,7 +75,7 @@ class GameScene(Scene):
         self.navigate_screen = pg.transform.scale(self.navigate_screen, (800, 600))
 
 
-        self.minimap = MiniMap(self.game_manager.current_map.path_name, scale = 0.06)
+        self.minimap = MiniMap(self.game_manager.current_map, scale = 0.06)
         self.navigator = Navigation(self.game_manager, GameSettings.TILE_SIZE)
 
         self.active_ui = None
@@ -263,7 +263,7 @@ class GameScene(Scene):
         new_manager = GameManager.load(path)
         if new_manager:
             self.game_manager.__dict__.update(new_manager.__dict__)
-            self.minimap = MiniMap(self.game_manager.current_map.path_name, scale=0.06)
+            self.minimap = MiniMap(self.game_manager.current_map, scale=0.06)
 
     def open_ui(self, scene_name: str):
         self.active_ui = scene_name
@@ -310,7 +310,7 @@ class GameScene(Scene):
         new_map = self.game_manager.current_map.path_name
 
         if old_map != new_map:
-            self.minimap.update(new_map)
+            self.minimap.update(self.game_manager.current_map)
 
         self.navigator.update(dt)
 
@@ -413,11 +413,11 @@ class GameScene(Scene):
 
         
         if self.online_manager and self.game_manager.player:
-            list_online = self.online_manager.get_list_players()
-            for player in list_online:
-                if player["map"] == self.game_manager.current_map.path_name:
-                    cam = self.game_manager.player.camera
-                    pos = cam.transform_position_as_position(Position(player["x"], player["y"]))
+            current_map = self.game_manager.current_map.path_name
+            cam = self.game_manager.player.camera
+            for player in self.online_manager.get_players():
+                if player.map == current_map:
+                    pos = cam.transform_position_as_position(Position(player.draw_x, player.draw_y))
                     self.sprite_online.update_pos(pos)
                     self.sprite_online.draw(screen)
                 # try:
@@ -16,5 +16,8 @@ class Settings:
     # Online
     IS_ONLINE: bool = False
     ONLINE_SERVER_URL: str = "http://localhost:8989"
+    ONLINE_BINARY_PROTOCOL: bool = True     # Ask the server for compact binary player frames
+    ONLINE_BATCH_FRAMES: bool = True        # Ask the server for one frame per tick
+    ONLINE_COMPRESSION: bool = True         # Offer per-message deflate to the server
     
 GameSettings = Settings()
\ No newline at end of file